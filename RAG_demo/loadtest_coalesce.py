@@ -0,0 +1,103 @@
+"""
+Load test gộp request: bắn nhiều request /search hoặc /chat GIỐNG NHAU cùng lúc (mô phỏng
+cả lớp mở cùng một study set) rồi so số request với số lời gọi embeddings/LLM thực sự.
+
+    python loadtest_coalesce.py --endpoint chat --concurrency 30 --bursts 5 --query "Định nghĩa RAG?"
+
+Server phải đang chạy (uvicorn rag_server:app). Chạy lại với COALESCE_ENABLED=0 ở server để so sánh.
+"""
+import json
+import time
+import argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+def _get(url: str) -> Dict[str, Any]:
+    with urllib.request.urlopen(url, timeout=120) as r:
+        return json.loads(r.read().decode("utf-8"))
+
+def _post(url: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    req = urllib.request.Request(
+        url, data=json.dumps(body).encode("utf-8"),
+        headers={"Content-Type": "application/json"}, method="POST",
+    )
+    with urllib.request.urlopen(req, timeout=300) as r:
+        return json.loads(r.read().decode("utf-8"))
+
+def _variants(query: str, n: int) -> List[str]:
+    # Khác hoa/thường + khoảng trắng nhưng cùng khoá sau khi chuẩn hoá
+    forms = [query, query.upper(), f"  {query}  ", query.replace(" ", "  ")]
+    return [forms[i % len(forms)] for i in range(n)]
+
+def run(base_url: str, endpoint: str, query: str, k: int, concurrency: int, bursts: int,
+        source_in: Optional[List[str]], pause: float) -> Dict[str, Any]:
+    before = _get(f"{base_url}/coalesce_stats")
+    latencies: List[float] = []
+    ids, errors = set(), 0
+
+    def one(q: str) -> None:
+        nonlocal errors
+        body: Dict[str, Any] = {"query": q, "k": k}
+        if source_in:
+            body["source_in"] = source_in
+        t0 = time.time()
+        try:
+            out = _post(f"{base_url}/{endpoint}", body)
+        except Exception as e:
+            errors += 1
+            print(f"[WARN] {e}")
+            return
+        latencies.append((time.time() - t0) * 1000)
+        if out.get("ok"):
+            ids.add(out.get("interaction_id"))
+        else:
+            errors += 1
+
+    t_start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(bursts):
+            list(pool.map(one, _variants(query, concurrency)))
+            time.sleep(pause)
+    elapsed = time.time() - t_start
+    after = _get(f"{base_url}/coalesce_stats")
+
+    requests = concurrency * bursts
+    upstream = {name: after["upstream_calls"][name] - before["upstream_calls"][name]
+                for name in after["upstream_calls"]}
+    latencies.sort()
+    return {
+        "endpoint": endpoint,
+        "requests": requests,
+        "errors": errors,
+        "distinct_interaction_ids": len(ids),
+        "leaders": after["leaders"] - before["leaders"],
+        "coalesced": after["coalesced"] - before["coalesced"],
+        "upstream_calls": upstream,
+        # Không gộp thì mỗi request ít nhất 1 embed_query (+1 LLM với /chat)
+        "upstream_reduction": {
+            name: round(1 - n / requests, 4) for name, n in upstream.items()
+            if name == "embed_query" or endpoint == "chat"
+        },
+        "latency_ms": {
+            "p50": round(latencies[len(latencies) // 2], 1) if latencies else None,
+            "p95": round(latencies[int(len(latencies) * 0.95) - 1], 1) if latencies else None,
+        },
+        "elapsed_s": round(elapsed, 2),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test gộp request /search, /chat trùng nhau.")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--endpoint", choices=["search", "chat"], default="search")
+    parser.add_argument("--query", default="Retrieval-Augmented Generation là gì?")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=30, help="Số request giống nhau mỗi đợt.")
+    parser.add_argument("--bursts", type=int, default=5, help="Số đợt.")
+    parser.add_argument("--pause", type=float, default=0.5, help="Nghỉ giữa các đợt (giây).")
+    parser.add_argument("--source-in", nargs="*", default=None)
+    args = parser.parse_args()
+
+    report = run(args.base_url.rstrip("/"), args.endpoint, args.query, args.k,
+                 args.concurrency, args.bursts, args.source_in, args.pause)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
@@ -1,7 +1,11 @@
 import os
 import re
+import json
 import uuid
-from typing import Optional, List, Tuple, Dict, Any
+import hashlib
+import threading
+from datetime import datetime
+from typing import Optional, List, Tuple, Dict, Any, Iterable
 from pathlib import Path
 from docling.document_converter import DocumentConverter
 
@@ -17,6 +21,13 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "")
 DEFAULT_INDEX_DIR = os.getenv("FAISS_INDEX_DIR", "faiss_index")
 EMB_MODEL = os.getenv("GEMINI_EMB_MODEL", "models/gemini-embedding-001")
 
+# Cache kết quả convert (docling → markdown) theo hash nội dung file + phiên bản converter
+CONVERSION_CACHE_DIR = os.getenv("CONVERSION_CACHE_DIR", "_cache/conversions")
+CONVERSION_CACHE_MAX_MB = float(os.getenv("CONVERSION_CACHE_MAX_MB", "1024"))
+
+SUPPORTED_DOCLING = {".pdf", ".docx", ".pptx", ".html", ".htm", ".png", ".jpg", ".jpeg", ".tif", ".tiff"}
+SUPPORTED_TEXT    = {".txt", ".md"}
+
 __all__ = [
     "load_data_from_folder",
     "build_embeddings",
@@ -24,6 +35,9 @@ __all__ = [
     "DEFAULT_INDEX_DIR",
     "route_and_chunk_text",
     "apply_metadata_quality_gate",
+    "extract_text",
+    "load_data_from_conversion_cache",
+    "forget_cached_sources",
 ]
 
 # =========================
@@ -34,6 +48,143 @@ def _docling_markdown_from_path(path: str) -> str:
     res = conv.convert(path)
     return res.document.export_to_markdown()
 
+# =========================
+# Conversion cache
+# =========================
+# Layout: <dir>/<sha[:2]>/<sha>.<converter>.md (+ .json meta), <dir>/sources.json: source → key
+_cache_lock = threading.Lock()
+
+def _converter_version(ext: str) -> str:
+    if ext in SUPPORTED_TEXT:
+        return "text-v1"
+    try:
+        from importlib.metadata import version
+        return f"docling-{version('docling')}"
+    except Exception:
+        return "docling-unknown"
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _cache_paths(key: str) -> Tuple[Path, Path]:
+    base = Path(CONVERSION_CACHE_DIR) / key[:2] / key
+    return base.with_name(key + ".md"), base.with_name(key + ".json")
+
+def _read_cache_sources() -> Dict[str, str]:
+    path = Path(CONVERSION_CACHE_DIR) / "sources.json"
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def _write_cache_sources(sources: Dict[str, str]) -> None:
+    path = Path(CONVERSION_CACHE_DIR) / "sources.json"
+    tmp = path.with_suffix(f".json.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(sources, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+def _evict_conversion_cache(sources: Dict[str, str], keep: str) -> None:
+    """
+    Xoá entry ít dùng nhất (theo mtime) cho tới khi tổng dung lượng <= CONVERSION_CACHE_MAX_MB
+    (trừ entry `keep` vừa ghi). Source trỏ tới entry bị evict cũng bị gỡ khỏi sources.json;
+    reindex_from_cache sẽ báo các source đó cần ingest lại.
+    """
+    root = Path(CONVERSION_CACHE_DIR)
+    entries = [(p.stat().st_mtime, p) for p in root.glob("*/*.md")]
+    total = sum(p.stat().st_size for _, p in entries)
+    limit = CONVERSION_CACHE_MAX_MB * 1024 * 1024
+    evicted = set()
+    for _, md in sorted(entries):
+        if total <= limit:
+            break
+        if md.stem == keep:
+            continue
+        total -= md.stat().st_size
+        md.unlink(missing_ok=True)
+        md.with_suffix(".json").unlink(missing_ok=True)
+        evicted.add(md.stem)
+    stale = [src for src, key in sources.items() if key in evicted]
+    if stale:
+        for src in stale:
+            del sources[src]
+        _write_cache_sources(sources)
+
+def forget_cached_sources(sources: Optional[Iterable[str]] = None, keep: Iterable[str] = ()) -> int:
+    """
+    Gỡ source khỏi sources.json khi chúng rời index (reset, xoá, ingest lỗi), để reindex từ
+    cache không dựng lại tài liệu người dùng đã xoá. sources=None: gỡ tất cả trừ `keep`.
+    Bản convert vẫn nằm trong cache (theo hash nội dung) cho tới khi bị evict.
+    """
+    drop = None if sources is None else {s.lower() for s in sources}
+    keep_set = {s.lower() for s in keep}
+    with _cache_lock:
+        current = _read_cache_sources()
+        remaining = {
+            src: key for src, key in current.items()
+            if src.lower() in keep_set or (drop is not None and src.lower() not in drop)
+        }
+        if len(remaining) != len(current):
+            _write_cache_sources(remaining)
+    return len(current) - len(remaining)
+
+def extract_text(path: str, source: Optional[str] = None) -> str:
+    """
+    Trích text của một file (docling cho pdf/docx/ảnh..., đọc thẳng cho txt/md).
+    Kết quả được cache theo sha256 nội dung + phiên bản converter, nên upload lại
+    cùng file hoặc chạy lại /ingest_folder không phải convert (OCR) lần nữa.
+    """
+    source = source or os.path.basename(path)
+    ext = Path(path).suffix.lower()
+    converter = _converter_version(ext)
+    key = f"{_file_sha256(path)}.{converter}"
+    md_path, meta_path = _cache_paths(key)
+
+    text: Optional[str] = None
+    if md_path.exists():
+        try:
+            os.utime(md_path)  # đánh dấu vừa dùng cho LRU
+            text = md_path.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            text = None  # vừa bị evict giữa chừng → convert lại
+
+    wrote = False
+    if text is None:
+        if ext in SUPPORTED_DOCLING:
+            text = (_docling_markdown_from_path(path) or "").strip()
+        elif ext in SUPPORTED_TEXT:
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                text = f.read().strip()
+        else:
+            raise ValueError(f"Unsupported file type: {ext}")
+        md_path.parent.mkdir(parents=True, exist_ok=True)
+        meta = json.dumps({
+            "converter": converter,
+            "ext": ext,
+            "created_at": datetime.utcnow().isoformat(),
+        })
+        # Tên tạm riêng cho mỗi writer: hai upload cùng file chạy song song đều replace được,
+        # bản nào thắng cũng có cùng nội dung
+        suffix = f".{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        for dest, content in ((md_path, text), (meta_path, meta)):
+            tmp = dest.with_name(dest.name + suffix)
+            tmp.write_text(content, encoding="utf-8")
+            os.replace(tmp, dest)
+        wrote = True
+
+    with _cache_lock:
+        sources = _read_cache_sources()
+        # Text rỗng không được index → không ghi source (giữ nguyên bản convert đang được index)
+        if text and sources.get(source) != key:
+            sources[source] = key
+            _write_cache_sources(sources)
+        if wrote:
+            _evict_conversion_cache(sources, keep=key)  # chỉ khi cache lớn thêm, không quét lại mỗi lần hit
+    return text
+
 # =========================
 # 1) Quality scoring & tier
 # =========================
@@ -200,27 +351,16 @@ def load_data_from_folder(folder_path: str = "data") -> List[Document]:
     if not os.path.isdir(folder_path):
         raise FileNotFoundError(f"Folder không tồn tại: {folder_path}")
 
-    SUPPORTED_DOCLING = {".pdf", ".docx", ".pptx", ".html", ".htm", ".png", ".jpg", ".jpeg", ".tif", ".tiff"}
-    SUPPORTED_TEXT    = {".txt", ".md"}
-
     for filename in os.listdir(folder_path):
         file_path = os.path.join(folder_path, filename)
         if not os.path.isfile(file_path):
             continue
         try:
             ext = Path(filename).suffix.lower()
-            text = ""
-
-            if ext in SUPPORTED_DOCLING:
-                md = _docling_markdown_from_path(file_path)
-                text = (md or "").strip()
-
-            elif ext in SUPPORTED_TEXT:
-                with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                    text = f.read().strip()
-            else:
+            if ext not in SUPPORTED_DOCLING and ext not in SUPPORTED_TEXT:
                 continue
 
+            text = extract_text(file_path, source=filename)
             if not text:
                 continue
 
@@ -232,6 +372,26 @@ def load_data_from_folder(folder_path: str = "data") -> List[Document]:
 
     return all_chunks
 
+def load_data_from_conversion_cache(sources: Optional[Iterable[str]] = None) -> List[Document]:
+    """
+    Chunk lại toàn bộ corpus chỉ từ conversion cache (không đọc file gốc, không chạy docling).
+    Dùng khi thử chiến lược chunking mới: đổi route_and_chunk_text rồi re-index.
+    sources: chỉ lấy các source này (không phân biệt hoa/thường), vd. các source đang có trong index.
+    """
+    wanted = None if sources is None else {s.lower() for s in sources}
+    all_chunks: List[Document] = []
+    for source, key in sorted(_read_cache_sources().items()):
+        if wanted is not None and source.lower() not in wanted:
+            continue
+        md_path, _ = _cache_paths(key)
+        try:
+            text = md_path.read_text(encoding="utf-8")
+        except OSError:
+            print(f"[WARN] Bỏ qua {source}: không còn trong conversion cache")
+            continue
+        all_chunks.extend(route_and_chunk_text(text=text, source=source))
+    return all_chunks
+
 # =========================
 # 6) Embeddings + FAISS
 # =========================
@@ -286,3 +446,29 @@ def apply_metadata_quality_gate(docs: List[Document], min_tier: str = "medium",
         else:
             low.append(d)
     return good + (low if include_low else [])
+
+# =========================
+# 8) CLI
+# =========================
+if __name__ == "__main__":
+    import argparse
+    from rag_index import ShardedIndex
+
+    parser = argparse.ArgumentParser(description="Tiện ích ingest offline.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_re = sub.add_parser(
+        "reindex-from-cache",
+        help="Chunk lại + index lại toàn bộ corpus chỉ từ conversion cache (không convert lại tài liệu).",
+    )
+    p_re.add_argument("--index-dir", required=True, help="Thư mục index đích (nên là thư mục mới, không dùng index server đang phục vụ).")
+    p_re.add_argument("--model", default=EMB_MODEL, help="Model embeddings.")
+    args = parser.parse_args()
+
+    if args.cmd == "reindex-from-cache":
+        chunks = load_data_from_conversion_cache()
+        if not chunks:
+            raise SystemExit("Conversion cache trống.")
+        vs = ShardedIndex(args.index_dir, build_embeddings(args.model))
+        added = vs.add_documents(chunks)
+        vs.compact(force=True)
+        print(f"[INFO] Đã index {added['added']}/{len(chunks)} chunk ({added['deduplicated']} trùng) vào {args.index_dir}: {vs.stats()}")
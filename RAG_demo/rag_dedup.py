@@ -0,0 +1,237 @@
+import os
+import re
+import hashlib
+import sqlite3
+import threading
+from typing import Optional, List, Tuple, Dict, Iterable
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1").lower() in {"1", "true", "yes"}
+SIMHASH_MAX_DISTANCE = int(os.getenv("DEDUP_SIMHASH_MAX_DISTANCE", "3"))
+# Chunk quá ngắn (header/footer) chỉ so khớp tuyệt đối, simhash không đủ tin cậy
+DEDUP_MIN_TOKENS = int(os.getenv("DEDUP_MIN_TOKENS", "8"))
+
+# 64 bit chia 4 band × 16 bit: hai simhash lệch <= 3 bit chắc chắn trùng ít nhất một band
+_BANDS = 4
+_BAND_BITS = 64 // _BANDS
+
+__all__ = [
+    "FingerprintStore",
+    "BatchFingerprints",
+    "fingerprint",
+    "DEDUP_ENABLED",
+]
+
+# =========================
+# 1) Fingerprints
+# =========================
+_word_re = re.compile(r"\w+", re.UNICODE)
+
+def _tokens(text: str) -> List[str]:
+    return _word_re.findall(text.lower())
+
+def _simhash(tokens: List[str], shingle: int = 3) -> int:
+    grams = [" ".join(tokens[i:i + shingle]) for i in range(max(1, len(tokens) - shingle + 1))]
+    weights = [0] * 64
+    for g in grams:
+        h = int.from_bytes(hashlib.blake2b(g.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+def fingerprint(text: str) -> Tuple[str, Optional[int]]:
+    """(hash tuyệt đối của text đã chuẩn hoá, simhash 64-bit hoặc None nếu chunk quá ngắn)."""
+    tokens = _tokens(text)
+    exact = hashlib.sha1(" ".join(tokens).encode("utf-8")).hexdigest()
+    return exact, (_simhash(tokens) if len(tokens) >= DEDUP_MIN_TOKENS else None)
+
+def _to_signed(v: int) -> int:
+    # SQLite INTEGER là int64 có dấu
+    return v - (1 << 64) if v >= (1 << 63) else v
+
+def _to_unsigned(v: int) -> int:
+    return v + (1 << 64) if v < 0 else v
+
+def _bands(simhash: int) -> List[Tuple[int, int]]:
+    mask = (1 << _BAND_BITS) - 1
+    return [(b, (simhash >> (b * _BAND_BITS)) & mask) for b in range(_BANDS)]
+
+# =========================
+# 2) On-disk store
+# =========================
+class FingerprintStore:
+    """
+    SQLite cạnh index (<index_root>/fingerprints.sqlite):
+      - chunks        : chunk_id → hash tuyệt đối, simhash, shard
+      - bands         : LSH band của simhash để tìm ứng viên gần trùng
+      - chunk_sources : các source cùng trỏ tới một chunk được giữ lại
+    chunk_id ở đây chính là id docstore của chunk trong FAISS.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                chunk_id TEXT PRIMARY KEY, exact TEXT NOT NULL, simhash INTEGER, shard_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_chunks_exact ON chunks(exact);
+            CREATE TABLE IF NOT EXISTS bands (band INTEGER, value INTEGER, chunk_id TEXT);
+            CREATE INDEX IF NOT EXISTS idx_bands ON bands(band, value);
+            CREATE INDEX IF NOT EXISTS idx_bands_chunk ON bands(chunk_id);
+            CREATE TABLE IF NOT EXISTS chunk_sources (
+                chunk_id TEXT, source TEXT, PRIMARY KEY (chunk_id, source)
+            );
+            CREATE INDEX IF NOT EXISTS idx_chunk_sources_source ON chunk_sources(source);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+        self._conn.commit()
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+            self._conn.commit()
+
+    def known(self, chunk_ids: Iterable[str]) -> set:
+        """Các chunk_id đã có fingerprint."""
+        ids = list(set(chunk_ids))
+        out = set()
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                part = ids[i:i + 500]
+                q = f"SELECT chunk_id FROM chunks WHERE chunk_id IN ({','.join('?' * len(part))})"
+                out.update(cid for (cid,) in self._conn.execute(q, part))
+        return out
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is None
+
+    def find(self, exact: str, simhash: Optional[int]) -> Optional[Tuple[str, str, str]]:
+        """Chunk đã có trùng/gần trùng: (chunk_id, shard_id, "exact"|"near") hoặc None."""
+        with self._lock:
+            row = self._conn.execute("SELECT chunk_id, shard_id FROM chunks WHERE exact = ? LIMIT 1", (exact,)).fetchone()
+            if row:
+                return row[0], row[1], "exact"
+            if simhash is None:
+                return None
+            seen = set()
+            for band, value in _bands(simhash):
+                for (cid,) in self._conn.execute("SELECT chunk_id FROM bands WHERE band = ? AND value = ?", (band, value)):
+                    if cid in seen:
+                        continue
+                    seen.add(cid)
+                    cand = self._conn.execute("SELECT simhash, shard_id FROM chunks WHERE chunk_id = ?", (cid,)).fetchone()
+                    if cand and cand[0] is not None and bin(_to_unsigned(cand[0]) ^ simhash).count("1") <= SIMHASH_MAX_DISTANCE:
+                        return cid, cand[1], "near"
+        return None
+
+    def register(self, rows: Iterable[Tuple[str, str, Optional[int], str, str]]) -> None:
+        """rows: (chunk_id, exact, simhash, shard_id, source)."""
+        with self._lock:
+            for chunk_id, exact, simhash, shard_id, source in rows:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)",
+                    (chunk_id, exact, _to_signed(simhash) if simhash is not None else None, shard_id),
+                )
+                # Đăng ký lại cùng chunk_id (backfill chạy lại, add lại cùng id) không nhân đôi band
+                self._conn.execute("DELETE FROM bands WHERE chunk_id = ?", (chunk_id,))
+                if simhash is not None:
+                    self._conn.executemany(
+                        "INSERT INTO bands VALUES (?, ?, ?)",
+                        [(b, v, chunk_id) for b, v in _bands(simhash)],
+                    )
+                self._conn.execute("INSERT OR IGNORE INTO chunk_sources VALUES (?, ?)", (chunk_id, source))
+            self._conn.commit()
+
+    def link(self, pairs: Iterable[Tuple[str, str]]) -> None:
+        """pairs: (chunk_id đã giữ lại, source mới cũng chứa nội dung đó)."""
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO chunk_sources VALUES (?, ?)", list(pairs))
+            self._conn.commit()
+
+    def sources_for(self, chunk_ids: Iterable[str]) -> Dict[str, List[str]]:
+        ids = list(set(chunk_ids))
+        out: Dict[str, List[str]] = {}
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                part = ids[i:i + 500]
+                q = f"SELECT chunk_id, source FROM chunk_sources WHERE chunk_id IN ({','.join('?' * len(part))})"
+                for cid, src in self._conn.execute(q, part):
+                    out.setdefault(cid, []).append(src)
+        for srcs in out.values():
+            srcs.sort()
+        return out
+
+    def all_sources(self) -> List[str]:
+        with self._lock:
+            return [src for (src,) in self._conn.execute("SELECT DISTINCT source FROM chunk_sources")]
+
+    def remove_source(self, source: str) -> List[Tuple[str, str]]:
+        """Gỡ source khỏi mọi chunk; trả về (chunk_id, shard_id) không còn source nào (cần xoá khỏi index)."""
+        with self._lock:
+            ids = [cid for (cid,) in self._conn.execute("SELECT chunk_id FROM chunk_sources WHERE source = ?", (source,))]
+            self._conn.execute("DELETE FROM chunk_sources WHERE source = ?", (source,))
+            orphans: List[Tuple[str, str]] = []
+            for cid in ids:
+                if self._conn.execute("SELECT 1 FROM chunk_sources WHERE chunk_id = ? LIMIT 1", (cid,)).fetchone():
+                    continue
+                row = self._conn.execute("SELECT shard_id FROM chunks WHERE chunk_id = ?", (cid,)).fetchone()
+                orphans.append((cid, row[0] if row else ""))
+                self._conn.execute("DELETE FROM chunks WHERE chunk_id = ?", (cid,))
+                self._conn.execute("DELETE FROM bands WHERE chunk_id = ?", (cid,))
+            self._conn.commit()
+            return orphans
+
+    def remove_chunks(self, chunk_ids: Iterable[str]) -> None:
+        """Xoá fingerprint của chunk đã bị xoá trực tiếp khỏi index (không qua source)."""
+        rows = [(cid,) for cid in set(chunk_ids)]
+        with self._lock:
+            for table in ("chunks", "bands", "chunk_sources"):
+                self._conn.executemany(f"DELETE FROM {table} WHERE chunk_id = ?", rows)
+            self._conn.commit()
+
+    def copy_from(self, other: "FingerprintStore") -> None:
+        """Thay toàn bộ nội dung bằng bản sao của store khác (dùng khi migration chuyển index)."""
+        with other._lock, self._lock:
+            other._conn.backup(self._conn)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+# =========================
+# 3) In-batch (chưa ghi xuống store)
+# =========================
+class BatchFingerprints:
+    """Trùng với chunk khác trong cùng lượt ingest (vd: header/footer lặp mỗi trang)."""
+
+    def __init__(self):
+        self._exact: Dict[str, Tuple[str, str]] = {}
+        self._bands: Dict[Tuple[int, int], List[Tuple[str, str, int]]] = {}
+
+    def find(self, exact: str, simhash: Optional[int]) -> Optional[Tuple[str, str, str]]:
+        if exact in self._exact:
+            return (*self._exact[exact], "exact")
+        if simhash is None:
+            return None
+        for key in _bands(simhash):
+            for chunk_id, shard_id, other in self._bands.get(key, []):
+                if bin(other ^ simhash).count("1") <= SIMHASH_MAX_DISTANCE:
+                    return chunk_id, shard_id, "near"
+        return None
+
+    def add(self, chunk_id: str, shard_id: str, exact: str, simhash: Optional[int]) -> None:
+        self._exact.setdefault(exact, (chunk_id, shard_id))
+        if simhash is not None:
+            for key in _bands(simhash):
+                self._bands.setdefault(key, []).append((chunk_id, shard_id, simhash))
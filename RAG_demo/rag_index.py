@@ -0,0 +1,1179 @@
+import os
+import re
+import json
+import hashlib
+import uuid
+import base64
+import shutil
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Tuple, Dict, Any, Iterable
+from pathlib import Path
+
+import numpy as np
+import faiss
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from rag_dedup import FingerprintStore, BatchFingerprints, fingerprint, DEDUP_ENABLED
+
+SHARD_COUNT = int(os.getenv("FAISS_SHARD_COUNT", "8"))
+SEARCH_WORKERS = int(os.getenv("FAISS_SEARCH_WORKERS", "8"))
+
+# Two-stage dense: lọc ứng viên bằng bản fp16 giảm chiều, re-score bằng vector đầy đủ (mmap)
+DENSE_TWO_STAGE = os.getenv("DENSE_TWO_STAGE", "0").lower() in {"1", "true", "yes"}
+DENSE_REDUCED_DIM = int(os.getenv("DENSE_REDUCED_DIM", "256"))
+DENSE_CANDIDATES = int(os.getenv("DENSE_CANDIDATES", "100"))
+# Số dòng mỗi lượt khi quét vector đầy đủ từ mmap (giới hạn RAM tạm của mode "full")
+DENSE_SCAN_ROWS = int(os.getenv("DENSE_SCAN_ROWS", "65536"))
+
+# Delta segment: gộp vào base khi vượt ngưỡng (hoặc gọi compact thủ công)
+DELTA_COMPACT_DOCS = int(os.getenv("DELTA_COMPACT_DOCS", "2000"))
+DELTA_COMPACT_TOMBSTONES = int(os.getenv("DELTA_COMPACT_TOMBSTONES", "2000"))
+
+# Trọng số & hằng số RRF giống EnsembleRetriever(weights=[0.5, 0.5]) trước đây
+HYBRID_WEIGHTS = (0.5, 0.5)
+RRF_C = 60
+# BM25 như BM25Retriever mặc định (Okapi, tách từ bằng split())
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+__all__ = [
+    "ShardedIndex",
+    "SHARD_COUNT",
+    "DENSE_TWO_STAGE",
+]
+
+# FAISS nhả GIL khi search → fan-out theo thread là đủ, không cần process
+_SEARCH_POOL = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="shard-search")
+# Một worker nền cho compaction để không tranh I/O với nhau
+_COMPACT_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shard-compact")
+
+# =========================
+# 1) Reader/writer lock
+# =========================
+class _RWLock:
+    """
+    Nhiều reader song song, writer độc quyền (theo từng shard).
+    Ưu tiên writer: khi đã có writer chờ thì reader mới phải đợi, để search liên tục
+    (mọi search đều fan-out qua mọi shard) không bỏ đói ingest. Không hỗ trợ read lồng nhau.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+# =========================
+# 2) File + two-stage dense helpers
+# =========================
+def _fsync_file(path: Path) -> None:
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+def _fsync_dir(path: Path) -> None:
+    # Để os.replace/rename trong thư mục bền vững qua crash (POSIX)
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _reduce(vectors: np.ndarray, dim: int) -> np.ndarray:
+    """Cắt còn `dim` chiều đầu (embedding kiểu Matryoshka) rồi chuẩn hoá L2."""
+    low = np.ascontiguousarray(vectors[:, :dim], dtype=np.float32)
+    faiss.normalize_L2(low)
+    return low
+
+def _sidecar_meta(n: int, d: int) -> Dict[str, int]:
+    return {"ntotal": n, "dim": d, "reduced_dim": DENSE_REDUCED_DIM}
+
+def _write_two_stage(vs: FAISS, base_dir: Path) -> None:
+    """Ghi dense_full.f32 + dense_low.faiss vào thư mục base, từ index đầy đủ đang nằm trong RAM."""
+    n, d = vs.index.ntotal, vs.index.d
+    full = vs.index.reconstruct_n(0, n) if n else np.zeros((0, d), dtype=np.float32)
+    tmp = base_dir / "dense_full.f32.tmp"
+    full.astype(np.float32).tofile(tmp)
+    _fsync_file(tmp)
+    os.replace(tmp, base_dir / "dense_full.f32")
+
+    low = faiss.IndexScalarQuantizer(min(DENSE_REDUCED_DIM, d), faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2)
+    if n:
+        low.add(_reduce(full, low.d))
+    faiss.write_index(low, str(base_dir / "dense_low.faiss"))
+    _fsync_file(base_dir / "dense_low.faiss")
+    (base_dir / "dense_two_stage.json").write_text(json.dumps(_sidecar_meta(n, d)), encoding="utf-8")
+
+def _load_two_stage(base_dir: Path, n: int, d: int) -> Tuple[faiss.Index, Optional[np.ndarray]]:
+    low = faiss.read_index(str(base_dir / "dense_low.faiss"))
+    full = np.memmap(base_dir / "dense_full.f32", dtype=np.float32, mode="r", shape=(n, d)) if n else None
+    return low, full
+
+def _dense_from_positions(vs: FAISS, positions: Iterable[int], dists: Iterable[float],
+                          tombstones: Optional[set] = None) -> List[Tuple[Document, float]]:
+    out: List[Tuple[Document, float]] = []
+    for pos, dist in zip(positions, dists):
+        doc_id = vs.index_to_docstore_id[int(pos)]
+        if tombstones and doc_id in tombstones:
+            continue
+        doc = vs.docstore.search(doc_id)
+        if isinstance(doc, Document):
+            out.append((doc, float(dist)))
+    return out
+
+# =========================
+# 3) BM25 theo đoạn corpus, thống kê dùng chung
+# =========================
+# (số doc, tổng độ dài, df của từng term trong query)
+_LexStats = Tuple[int, float, Dict[str, int]]
+
+def _bm25_tokens(text: str) -> List[str]:
+    return text.split()
+
+def _merge_lex_stats(parts: Iterable[_LexStats]) -> _LexStats:
+    n, total, df = 0, 0.0, Counter()
+    for pn, ptotal, pdf in parts:
+        n, total = n + pn, total + ptotal
+        df.update(pdf)
+    return n, total, dict(df)
+
+class _LexicalSegment:
+    """
+    Posting list của một đoạn corpus (base hoặc delta của shard).
+    Không tự giữ IDF: điểm luôn tính với thống kê (N, df, avgdl) truyền vào, để điểm của
+    các đoạn khác nhau so sánh được với nhau khi gộp.
+    """
+
+    def __init__(self, docs: List[Document]):
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        lengths: List[int] = []
+        for pos, d in enumerate(docs):
+            tokens = _bm25_tokens(d.page_content)
+            lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                p = postings.setdefault(term, ([], []))
+                p[0].append(pos)
+                p[1].append(tf)
+        self.doc_len = np.asarray(lengths, dtype=np.float32)
+        self.postings = {t: (np.asarray(p, dtype=np.int64), np.asarray(f, dtype=np.float32)) for t, (p, f) in postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.doc_len)
+
+    def stats(self, terms: Iterable[str], excluded: Optional[np.ndarray] = None) -> _LexStats:
+        """Thống kê của đoạn, bỏ qua các vị trí `excluded` (doc đã bị tombstone)."""
+        n, total = len(self.doc_len), float(self.doc_len.sum())
+        df: Dict[str, int] = {}
+        if excluded is not None and len(excluded):
+            n, total = n - len(excluded), total - float(self.doc_len[excluded].sum())
+        for t in set(terms):
+            pos = self.postings.get(t, (np.empty(0, dtype=np.int64), None))[0]
+            if excluded is not None and len(excluded) and len(pos):
+                df[t] = int(len(pos) - np.isin(pos, excluded).sum())
+            else:
+                df[t] = int(len(pos))
+        return n, total, df
+
+    def score(self, terms: List[str], stats: _LexStats) -> List[Tuple[int, float]]:
+        """(vị trí, điểm BM25) của các doc chứa ít nhất một term."""
+        n, total, df = stats
+        avgdl = total / n if n else 1.0
+        scores = np.zeros(len(self.doc_len), dtype=np.float32)
+        matched = np.zeros(len(self.doc_len), dtype=bool)
+        for t in terms:  # term lặp trong query được cộng lặp, như BM25Okapi
+            hit = self.postings.get(t)
+            if hit is None:
+                continue
+            pos, tf = hit
+            n_t = df.get(t, 0)
+            # IDF dạng Lucene, luôn dương: không có điểm âm khi term phủ quá nửa corpus
+            idf = np.log(1.0 + (n - n_t + 0.5) / (n_t + 0.5))
+            scores[pos] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len[pos] / avgdl))
+            matched[pos] = True
+        found = np.nonzero(matched)[0]
+        return list(zip(found.tolist(), scores[found].tolist()))
+
+# =========================
+# 4) One shard = base FAISS + delta segment + BM25
+# =========================
+def _encode_vector(vec: np.ndarray) -> str:
+    return base64.b64encode(np.asarray(vec, dtype=np.float32).tobytes()).decode("ascii")
+
+def _decode_vector(data: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(data), dtype=np.float32)
+
+class _Shard:
+    """
+    Một shard kiểu LSM:
+      - base  : thư mục base-<gen>/ (index.faiss/index.pkl + file phụ two-stage), bất biến;
+                file CURRENT trỏ tới thế hệ đang dùng. Compaction dựng thế hệ mới rồi chỉ
+                đổi CURRENT (một os.replace), nên crash giữa chừng không để lại cặp file lệch.
+                Shard cũ có index.faiss ngay trong thư mục shard vẫn đọc được.
+      - delta : delta.jsonl append-only (chunk mới kèm vector, và tombstone khi xoá);
+                nạp toàn bộ vào RAM, search brute-force cùng với base
+    Ghi nhỏ chỉ append vài dòng vào delta, chi phí không phụ thuộc kích thước base.
+    Khi bật two-stage, base có thêm 2 file phụ:
+      - dense_low.faiss: bản fp16 giảm chiều, nằm trong RAM, dùng để lấy ứng viên
+      - dense_full.f32 : vector float32 đầy đủ, đọc qua mmap để re-score
+    và index FAISS đầy đủ chỉ được nạp lại vào RAM khi compaction.
+    """
+
+    def __init__(self, shard_id: str, path: Path, embeddings: Embeddings, two_stage: bool = DENSE_TWO_STAGE):
+        self.shard_id = shard_id
+        self.path = path
+        self.embeddings = embeddings
+        self.two_stage = two_stage
+        self.lock = _RWLock()
+        self._compact_lock = threading.Lock()
+        self._bm25_lock = threading.Lock()
+        self._bm25_base: Optional[Tuple[_LexicalSegment, List[str], Dict[str, int]]] = None
+        self._bm25_delta: Optional[Tuple[_LexicalSegment, List[str]]] = None
+        self._low: Optional[faiss.Index] = None
+        self._full: Optional[np.ndarray] = None
+        self._full_resident = True
+        # (thư mục base, IndexFlatL2 đầy đủ) nạp tạm cho eval so sánh full vs two-stage
+        self._baseline: Optional[Tuple[Path, faiss.Index]] = None
+        self.vs: Optional[FAISS] = None
+        # delta: id → (Document, vector); tombstones: id đã xoá (áp lên base)
+        self._delta: Dict[str, Tuple[Document, np.ndarray]] = {}
+        self._delta_matrix: Optional[Tuple[List[str], np.ndarray]] = None
+        self._tombstones: set = set()
+        self._base_dir = self._read_current()
+        if self._base_dir is not None:
+            self.vs = FAISS.load_local(str(self._base_dir), embeddings, allow_dangerous_deserialization=True)
+            if self.two_stage:
+                self._open_two_stage()
+        self._remove_stale_bases()
+        self._replay_delta()
+
+    # ---- base generations ----
+    def _read_current(self) -> Optional[Path]:
+        pointer = self.path / "CURRENT"
+        if pointer.exists():
+            return self.path / pointer.read_text(encoding="utf-8").strip()
+        if (self.path / "index.faiss").exists():
+            return self.path  # layout cũ: base nằm thẳng trong thư mục shard
+        return None
+
+    def _write_current(self, name: str) -> None:
+        tmp = self.path / "CURRENT.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path / "CURRENT")
+        _fsync_dir(self.path)
+
+    def _next_base_name(self) -> str:
+        gen = 0
+        if self._base_dir is not None and self._base_dir.name.startswith("base-"):
+            gen = int(self._base_dir.name[len("base-"):])
+        return f"base-{gen + 1:08d}"
+
+    def _remove_stale_bases(self) -> None:
+        """Xoá thế hệ base không còn được CURRENT trỏ tới (compaction dở dang, hoặc base cũ)."""
+        if not self.path.is_dir():
+            return
+        for p in self.path.iterdir():
+            if p.is_dir() and (p.name.startswith("base-") or p.name == ".compact") and p != self._base_dir:
+                shutil.rmtree(p, ignore_errors=True)
+        if self._base_dir is not None and self._base_dir != self.path:
+            # Base layout cũ đã được thay bằng thế hệ base-<gen>
+            for name in ("index.faiss", "index.pkl", "dense_full.f32", "dense_low.faiss", "dense_two_stage.json"):
+                (self.path / name).unlink(missing_ok=True)
+
+    # ---- sizes ----
+    def _base_ids(self) -> Dict[str, Any]:
+        return self.vs.docstore._dict if self.vs is not None else {}
+
+    @property
+    def base_count(self) -> int:
+        return len(self.vs.index_to_docstore_id) if self.vs is not None else 0
+
+    @property
+    def ntotal(self) -> int:
+        base = self._base_ids()
+        return self.base_count - sum(1 for i in self._tombstones if i in base) + len(self._delta)
+
+    @property
+    def dim(self) -> Optional[int]:
+        if self.vs is not None:
+            return int(self.vs.index.d)
+        for _, vec in self._delta.values():
+            return int(vec.shape[0])
+        return None
+
+    def delta_stats(self) -> Dict[str, int]:
+        return {"delta_docs": len(self._delta), "tombstones": len(self._tombstones)}
+
+    def needs_compaction(self) -> bool:
+        return len(self._delta) >= DELTA_COMPACT_DOCS or len(self._tombstones) >= DELTA_COMPACT_TOMBSTONES
+
+    def items(self) -> List[Tuple[str, Document]]:
+        with self.lock.read():
+            out = [(i, d) for i, d in self._base_ids().items() if i not in self._tombstones]
+            out.extend((i, d) for i, (d, _) in self._delta.items())
+            return out
+
+    def documents(self) -> List[Document]:
+        return [d for _, d in self.items()]
+
+    # ---- delta log ----
+    def _apply_add(self, doc_id: str, doc: Document, vec: np.ndarray, replay: bool = False) -> bool:
+        if doc_id in self._base_ids() and doc_id not in self._tombstones:
+            if replay:
+                return False  # đã được compaction gộp vào base trước khi log kịp ghi lại
+            raise ValueError(f"Tried to add ids that already exist: {doc_id}")
+        self._delta[doc_id] = (doc, vec)
+        return True
+
+    def _apply_delete(self, doc_id: str) -> bool:
+        in_delta = self._delta.pop(doc_id, None) is not None
+        if in_delta or (doc_id in self._base_ids() and doc_id not in self._tombstones):
+            self._tombstones.add(doc_id)
+            return True
+        return False
+
+    def _replay_delta(self) -> None:
+        log = self.path / "delta.jsonl"
+        if not log.exists():
+            return
+        with open(log, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # dòng cuối ghi dở khi crash
+                if rec.get("op") == "add":
+                    doc = Document(page_content=rec["text"], metadata=rec.get("metadata") or {})
+                    self._apply_add(rec["id"], doc, _decode_vector(rec["vec"]), replay=True)
+                elif rec.get("op") == "del":
+                    self._apply_delete(rec["id"])
+
+    def _append_delta(self, records: List[Dict[str, Any]]) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / "delta.jsonl", "a", encoding="utf-8") as f:
+            for rec in records:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite_delta(self) -> None:
+        records = [{"op": "del", "id": i} for i in sorted(self._tombstones)]
+        records += [
+            {"op": "add", "id": i, "text": d.page_content, "metadata": d.metadata, "vec": _encode_vector(v)}
+            for i, (d, v) in self._delta.items()
+        ]
+        tmp = self.path / "delta.jsonl.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for rec in records:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path / "delta.jsonl")
+        _fsync_dir(self.path)
+
+    def _delta_changed(self) -> None:
+        self._delta_matrix = None
+        self._bm25_delta = None
+
+    # ---- two-stage sidecars ----
+    def _open_two_stage(self) -> None:
+        meta_path = self._base_dir / "dense_two_stage.json"
+        meta = json.loads(meta_path.read_text(encoding="utf-8")) if meta_path.exists() else {}
+        n, d = self.base_count, int(self.vs.index.d)
+        if meta != _sidecar_meta(n, d):
+            self._ensure_full_index()
+            _write_two_stage(self.vs, self._base_dir)
+        self._low, self._full = _load_two_stage(self._base_dir, n, d)
+        # Vector đầy đủ chỉ còn trên đĩa; giữ index rỗng cùng chiều để LangChain FAISS vẫn hợp lệ
+        self.vs.index = faiss.IndexFlatL2(d)
+        self._full_resident = False
+
+    def _ensure_full_index(self) -> None:
+        if not self._full_resident:
+            self.vs.index = faiss.read_index(str(self._base_dir / "index.faiss"))
+            self._low, self._full = None, None
+            self._full_resident = True
+
+    # ---- writes (chỉ chạm delta) ----
+    def add(self, docs: List[Document], vectors: List[List[float]], ids: Optional[List[str]] = None) -> None:
+        ids = ids or [str(uuid.uuid4()) for _ in docs]
+        records = []
+        with self.lock.write():
+            for doc_id, d, v in zip(ids, docs, vectors):
+                vec = np.asarray(v, dtype=np.float32)
+                self._apply_add(doc_id, d, vec)
+                records.append({"op": "add", "id": doc_id, "text": d.page_content,
+                                "metadata": d.metadata, "vec": _encode_vector(vec)})
+            self._append_delta(records)
+            self._delta_changed()
+
+    def delete_ids(self, ids: Iterable[str]) -> int:
+        with self.lock.write():
+            deleted = [i for i in ids if self._apply_delete(i)]
+            if deleted:
+                self._append_delta([{"op": "del", "id": i} for i in deleted])
+                self._delta_changed()
+            return len(deleted)
+
+    def delete_source(self, source: str) -> int:
+        ids = [doc_id for doc_id, d in self.items() if d.metadata.get("source") == source]
+        return self.delete_ids(ids)
+
+    def existing_ids(self, ids: Iterable[str]) -> set:
+        with self.lock.read():
+            base = self._base_ids()
+            return {i for i in ids if i in self._delta or (i in base and i not in self._tombstones)}
+
+    # ---- compaction ----
+    def compact(self) -> bool:
+        """
+        Gộp delta + tombstone vào base. Thế hệ base mới (kể cả file phụ two-stage) được dựng
+        và fsync hoàn toàn ngoài lock; trong write lock chỉ đổi CURRENT và ghi lại delta.
+        """
+        with self._compact_lock:
+            with self.lock.read():
+                snap_delta = dict(self._delta)
+                snap_tombs = set(self._tombstones)
+                old_dir = self._base_dir
+            if not snap_delta and not snap_tombs:
+                return False
+
+            base: Optional[FAISS] = None
+            if old_dir is not None:
+                base = FAISS.load_local(str(old_dir), self.embeddings, allow_dangerous_deserialization=True)
+                dead = [i for i in snap_tombs if i in base.docstore._dict]
+                if dead:
+                    base.delete(dead)
+            if snap_delta:
+                text_embeddings = [(d.page_content, v.tolist()) for d, v in snap_delta.values()]
+                metadatas = [d.metadata for d, _ in snap_delta.values()]
+                if base is None:
+                    base = FAISS.from_embeddings(text_embeddings, self.embeddings, metadatas=metadatas, ids=list(snap_delta))
+                else:
+                    base.add_embeddings(text_embeddings, metadatas=metadatas, ids=list(snap_delta))
+            if base is None:
+                return False
+
+            new_dir = self.path / self._next_base_name()
+            shutil.rmtree(new_dir, ignore_errors=True)
+            base.save_local(str(new_dir))
+            for name in ("index.faiss", "index.pkl"):
+                _fsync_file(new_dir / name)
+            low, full = None, None
+            if self.two_stage:
+                _write_two_stage(base, new_dir)
+                low, full = _load_two_stage(new_dir, base.index.ntotal, base.index.d)
+                base.index = faiss.IndexFlatL2(base.index.d)
+            _fsync_dir(new_dir)
+
+            with self.lock.write():
+                self._write_current(new_dir.name)
+                self._base_dir = new_dir
+                self.vs = base
+                self._low, self._full = low, full
+                self._full_resident = not self.two_stage
+                # Giữ lại phần ghi/xoá xảy ra trong lúc compaction
+                self._delta = {i: v for i, v in self._delta.items() if snap_delta.get(i) is not v}
+                self._tombstones = {i for i in self._tombstones - snap_tombs if i in base.docstore._dict}
+                self._rewrite_delta()
+                self._delta_changed()
+                self._bm25_base = None
+            self._remove_stale_bases()
+            return True
+
+    # ---- reads ----
+    def _lexical_segments(self) -> Tuple[Optional[Tuple[_LexicalSegment, List[str], Dict[str, int]]],
+                                         Optional[Tuple[_LexicalSegment, List[str]]]]:
+        # Gọi trong read lock: writer không thể chạy song song nên cache an toàn.
+        # Đoạn base chỉ dựng lại sau compaction; đoạn delta thì nhỏ, dựng lại khi delta đổi.
+        # Mỗi đoạn đi kèm danh sách docstore id theo đúng thứ tự corpus.
+        base_docs = self._base_ids()
+        with self._bm25_lock:
+            if self._bm25_base is None and base_docs:
+                ids = list(base_docs)
+                self._bm25_base = (_LexicalSegment([base_docs[i] for i in ids]), ids, {i: p for p, i in enumerate(ids)})
+            if self._bm25_delta is None and self._delta:
+                ids = list(self._delta)
+                self._bm25_delta = (_LexicalSegment([self._delta[i][0] for i in ids]), ids)
+            return self._bm25_base, self._bm25_delta
+
+    def _tombstoned_positions(self, base: Tuple[_LexicalSegment, List[str], Dict[str, int]]) -> np.ndarray:
+        _, _, pos_of = base
+        return np.asarray(sorted(pos_of[i] for i in self._tombstones if i in pos_of), dtype=np.int64)
+
+    def _lexical_stats(self, terms: List[str]) -> _LexStats:
+        base, delta = self._lexical_segments()
+        parts: List[_LexStats] = []
+        if base is not None:
+            parts.append(base[0].stats(terms, self._tombstoned_positions(base)))
+        if delta is not None:
+            parts.append(delta[0].stats(terms))
+        return _merge_lex_stats(parts)
+
+    def _lexical(self, query: str, k: int, stats: Optional[_LexStats] = None) -> List[Tuple[Document, float]]:
+        # Base và delta được chấm với cùng thống kê corpus, nên điểm gộp/sắp xếp chung được
+        terms = _bm25_tokens(query)
+        stats = stats or self._lexical_stats(terms)
+        base, delta = self._lexical_segments()
+        hits: List[Tuple[Document, float]] = []
+        if base is not None:
+            seg, ids, _ = base
+            base_docs = self._base_ids()
+            hits.extend(
+                (base_docs[ids[pos]], score) for pos, score in seg.score(terms, stats)
+                if ids[pos] not in self._tombstones
+            )
+        if delta is not None:
+            seg, ids = delta
+            hits.extend((self._delta[ids[pos]][0], score) for pos, score in seg.score(terms, stats))
+        hits.sort(key=lambda x: x[1], reverse=True)
+        return hits[:k]
+
+    def _dense_base(self, vector: List[float], k: int, mode: str) -> List[Tuple[Document, float]]:
+        """mode: "auto" | "full" | "two_stage". Khoảng cách trả về luôn là L2² trên vector đầy đủ."""
+        if not self.base_count:
+            return []
+        fetch_k = k + len(self._tombstones)
+        if self._full_resident:
+            scores, positions = self.vs.index.search(np.asarray([vector], dtype=np.float32), min(fetch_k, self.base_count))
+            keep = positions[0] >= 0
+            return _dense_from_positions(self.vs, positions[0][keep], scores[0][keep], self._tombstones)[:k]
+        q = np.asarray(vector, dtype=np.float32)
+        if mode == "full":
+            # Search phẳng chính xác: IndexFlatL2 đã nạp (như khi tắt two-stage), hoặc quét mmap theo lô
+            baseline = self._baseline
+            if baseline is not None and baseline[0] == self._base_dir:
+                scores, positions = baseline[1].search(q[None, :], min(fetch_k, self.base_count))
+                scores, positions = scores[0], positions[0]
+            else:
+                scores, positions = self._scan_full(q, fetch_k)
+            keep = positions >= 0
+            return _dense_from_positions(self.vs, positions[keep], scores[keep], self._tombstones)[:k]
+
+        depth = min(max(DENSE_CANDIDATES, k) + len(self._tombstones), self.base_count)
+        _, cand = self._low.search(_reduce(q[None, :], self._low.d), depth)
+        cand = np.sort(cand[0][cand[0] >= 0])
+        dists = ((self._full[cand] - q) ** 2).sum(axis=1)
+        order = np.argsort(dists)[:fetch_k]
+        return _dense_from_positions(self.vs, cand[order], dists[order], self._tombstones)[:k]
+
+    def _scan_full(self, q: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """k-NN chính xác bằng kernel flat L2 của FAISS trên dense_full.f32, từng lô DENSE_SCAN_ROWS dòng."""
+        all_d, all_i = [], []
+        for start in range(0, self.base_count, DENSE_SCAN_ROWS):
+            block = np.ascontiguousarray(self._full[start:start + DENSE_SCAN_ROWS])
+            dists, pos = faiss.knn(q[None, :], block, min(k, len(block)))
+            all_d.append(dists[0])
+            all_i.append(pos[0] + start)
+        dists, pos = np.concatenate(all_d), np.concatenate(all_i)
+        order = np.argsort(dists)[:k]
+        return dists[order], pos[order]
+
+    def load_baseline(self) -> None:
+        """Nạp tạm index.faiss đầy đủ khi vector chỉ còn trên đĩa (chỉ để eval)."""
+        with self.lock.read():
+            if not self._full_resident and self._base_dir is not None and self.base_count:
+                self._baseline = (self._base_dir, faiss.read_index(str(self._base_dir / "index.faiss")))
+
+    def release_baseline(self) -> None:
+        self._baseline = None
+
+    def _dense_delta(self, vector: List[float], k: int) -> List[Tuple[Document, float]]:
+        if not self._delta:
+            return []
+        with self._bm25_lock:
+            if self._delta_matrix is None:
+                self._delta_matrix = (list(self._delta), np.stack([v for _, v in self._delta.values()]))
+            ids, mat = self._delta_matrix
+        dists = ((mat - np.asarray(vector, dtype=np.float32)) ** 2).sum(axis=1)
+        top = np.argsort(dists)[:k]
+        return [(self._delta[ids[i]][0], float(dists[i])) for i in top]
+
+    def _dense(self, vector: List[float], k: int, mode: str) -> List[Tuple[Document, float]]:
+        hits = self._dense_base(vector, k, mode) + self._dense_delta(vector, k)
+        hits.sort(key=lambda x: x[1])
+        return hits[:k]
+
+    def lexical_stats(self, terms: List[str]) -> _LexStats:
+        with self.lock.read():
+            return self._lexical_stats(terms)
+
+    def search(self, query: str, vector: List[float], k: int, mode: str = "auto",
+               lex_stats: Optional[_LexStats] = None) -> Tuple[List[Tuple[Document, float]], List[Tuple[Document, float]]]:
+        """lex_stats: thống kê BM25 toàn index; None = chỉ của shard này."""
+        with self.lock.read():
+            if self.ntotal == 0:
+                return [], []
+            dense = self._dense(vector, k, mode)
+            lexical = self._lexical(query, k, lex_stats)
+        return dense, lexical
+
+    def dense_search(self, vector: List[float], k: int, mode: str = "auto") -> List[Tuple[Document, float]]:
+        with self.lock.read():
+            if self.ntotal == 0:
+                return []
+            return self._dense(vector, k, mode)
+
+    def memory_bytes(self) -> Dict[str, int]:
+        n, d = self.base_count, self.dim or 0
+        low_d = self._low.d if self._low is not None else 0
+        delta = len(self._delta) * d * 4
+        return {
+            "full_f32": n * d * 4 + delta,
+            "reduced_f16": n * low_d * 2,
+            "resident_dense": (n * d * 4 if self._full_resident else n * low_d * 2) + delta,
+        }
+
+# =========================
+# 5) Fusion helper
+# =========================
+def _weighted_rrf(ranked_lists: List[List[Document]], weights: Iterable[float]) -> List[Document]:
+    """Weighted Reciprocal Rank Fusion, khử trùng theo page_content (như EnsembleRetriever)."""
+    scores: Dict[str, float] = {}
+    first: Dict[str, Document] = {}
+    for docs, w in zip(ranked_lists, weights):
+        for rank, d in enumerate(docs, start=1):
+            key = d.page_content
+            scores[key] = scores.get(key, 0.0) + w / (rank + RRF_C)
+            first.setdefault(key, d)
+    return [first[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+# =========================
+# 6) Public: sharded index
+# =========================
+class ShardedIndex:
+    """
+    Index chia shard theo nhóm nguồn (group) hoặc theo hash tên file.
+    Layout: <root>/manifest.json + <root>/shards/<shard_id>/{CURRENT,base-<gen>/,delta.jsonl}.
+    Search fan-out song song trên các shard rồi gộp top-k; ghi vào một shard
+    chỉ khoá shard đó, và chỉ append vào delta của shard (compaction chạy nền).
+    Chunk trùng/gần trùng không được embed lại mà chỉ gắn thêm source vào chunk
+    đã có (<root>/fingerprints.sqlite); id docstore luôn bằng chunk_id.
+    """
+
+    def __init__(self, root: str, embeddings: Embeddings, shard_count: int = SHARD_COUNT,
+                 two_stage: bool = DENSE_TWO_STAGE):
+        self.root = Path(root)
+        self.embeddings = embeddings
+        self.two_stage = two_stage
+        self._lock = threading.Lock()  # bảo vệ manifest + dict shard
+        self._manifest = self._read_manifest(shard_count)
+        self._manifest.setdefault("links", {})
+        self._shards: Dict[str, _Shard] = {}
+        self._fingerprints: Optional[FingerprintStore] = None
+        # Fingerprint cho chunk có từ trước khi có dedup được đăng ký ở thread nền
+        self._backfill_done = threading.Event()
+        self._backfill_stop = threading.Event()
+        self._backfill_thread: Optional[threading.Thread] = None
+        self._version = 0  # tăng sau mỗi lần ghi, dùng làm khoá gộp/cache kết quả search
+
+        shards_dir = self.root / "shards"
+        if shards_dir.is_dir():
+            for p in sorted(shards_dir.iterdir()):
+                if p.is_dir():
+                    self._shards[p.name] = _Shard(p.name, p, embeddings, two_stage)
+        self._split_legacy_index()
+        self._init_backfill()
+
+    # ---- manifest ----
+    def _read_manifest(self, shard_count: int) -> Dict[str, Any]:
+        path = self.root / "manifest.json"
+        if path.exists():
+            return json.loads(path.read_text(encoding="utf-8"))
+        # shard_count được cố định lúc tạo index để routing không đổi khi đổi ENV
+        return {"shard_count": shard_count, "sources": {}}
+
+    def _write_manifest(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.root / "manifest.json.tmp"
+        tmp.write_text(json.dumps(self._manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, self.root / "manifest.json")
+
+    def shard_for(self, source: str, group: Optional[str] = None) -> str:
+        if group:
+            return "g_" + re.sub(r"[^A-Za-z0-9_-]", "_", group)
+        digest = hashlib.sha1(source.lower().encode("utf-8")).hexdigest()
+        bucket = int(digest[:8], 16) % int(self._manifest["shard_count"])
+        return f"h{bucket:02d}"
+
+    def _get_shard(self, shard_id: str) -> _Shard:
+        with self._lock:
+            shard = self._shards.get(shard_id)
+            if shard is None:
+                shard = _Shard(shard_id, self.root / "shards" / shard_id, self.embeddings, self.two_stage)
+                self._shards[shard_id] = shard
+            return shard
+
+    def _route(self, source_in: Optional[List[str]]) -> List[_Shard]:
+        with self._lock:
+            if not source_in:
+                return list(self._shards.values())
+            mapping, links = self._manifest["sources"], self._manifest["links"]
+            wanted = {mapping[s.lower()] for s in source_in if s.lower() in mapping}
+            # Source có chunk trùng được gắn vào chunk nằm ở shard khác
+            for s in source_in:
+                wanted.update(links.get(s.lower(), []))
+            return [self._shards[sid] for sid in sorted(wanted) if sid in self._shards]
+
+    # ---- fingerprints (dedup) ----
+    def _fingerprint_store(self, create: bool = True) -> Optional[FingerprintStore]:
+        with self._lock:
+            if self._fingerprints is None:
+                path = self.root / "fingerprints.sqlite"
+                existed = path.exists()
+                if not create and not existed:
+                    return None
+                self._fingerprints = FingerprintStore(str(path))
+                if not existed:
+                    self._fingerprints.set_meta("backfilled", "1" if self._backfill_done.is_set() else "0")
+            return self._fingerprints
+
+    def _init_backfill(self) -> None:
+        if (self.root / "fingerprints.sqlite").exists():
+            # Store tạo trước khi có cờ "backfilled" luôn đã được backfill đầy đủ
+            if self._fingerprint_store().get_meta("backfilled") in (None, "1"):
+                self._backfill_done.set()
+                return
+        elif self.is_empty():
+            self._backfill_done.set()
+            return
+        self.start_fingerprint_backfill()
+
+    def start_fingerprint_backfill(self) -> None:
+        """
+        Đăng ký fingerprint cho chunk có từ trước khi có dedup (không gộp chúng), ở thread nền
+        để không chặn request đầu tiên sau khi nâng cấp. Trong lúc chạy, dedup chỉ thấy phần
+        đã đăng ký; delete_source vẫn xoá đúng chunk chưa đăng ký.
+        """
+        with self._lock:
+            if self._backfill_thread is not None and self._backfill_thread.is_alive():
+                return
+            self._backfill_done.clear()
+            self._backfill_stop.clear()
+            self._backfill_thread = threading.Thread(target=self._backfill_fingerprints, name="fingerprint-backfill", daemon=True)
+            self._backfill_thread.start()
+
+    def _backfill_fingerprints(self, batch_size: int = 500) -> None:
+        try:
+            store = self._fingerprint_store()
+            store.set_meta("backfilled", "0")
+            for shard_id, s in sorted(list(self._shards.items())):
+                items = s.items()
+                for i in range(0, len(items), batch_size):
+                    if self._backfill_stop.is_set():
+                        return
+                    batch = items[i:i + batch_size]
+                    # Chunk đã đăng ký (vd: ingest mới) giữ nguyên danh sách source của nó
+                    known = store.known(doc_id for doc_id, _ in batch)
+                    rows = []
+                    for doc_id, d in batch:
+                        if doc_id not in known:
+                            exact, sim = fingerprint(d.page_content)
+                            rows.append((doc_id, exact, sim, shard_id, str(d.metadata.get("source", ""))))
+                    store.register(rows)
+                    # Chunk bị xoá trong lúc đang tính fingerprint thì gỡ lại
+                    gone = {r[0] for r in rows} - s.existing_ids(r[0] for r in rows)
+                    if gone:
+                        store.remove_chunks(gone)
+            store.set_meta("backfilled", "1")
+            self._backfill_done.set()
+            print(f"[INFO] Đã backfill fingerprint dedup: {self.root}")
+        except Exception as e:
+            print(f"[WARN] Backfill fingerprint dedup lỗi ({self.root}): {e}")
+
+    def close(self) -> None:
+        self._backfill_stop.set()
+        if self._backfill_thread is not None:
+            self._backfill_thread.join()
+        with self._lock:
+            if self._fingerprints is not None:
+                self._fingerprints.close()
+                self._fingerprints = None
+
+    def copy_fingerprints_from(self, other: "ShardedIndex") -> None:
+        """Chép fingerprint + liên kết source của index khác (cùng chunk_id), vd. sau migration."""
+        src = other._fingerprint_store(create=False)
+        if src is not None:
+            self._fingerprint_store().copy_from(src)
+        with self._lock:
+            self._manifest["links"] = json.loads(json.dumps(other._manifest.get("links", {})))
+            self._write_manifest()
+            self._version += 1
+        if src is not None and not other._backfill_done.is_set():
+            self.start_fingerprint_backfill()  # nguồn chưa backfill xong → tự hoàn tất phần còn thiếu
+
+    def _with_sources(self, docs: List[Document]) -> List[Document]:
+        """Bản sao Document kèm metadata["sources"]: mọi source có nội dung chunk này."""
+        store = self._fingerprint_store(create=False)
+        mapping = store.sources_for(str(d.metadata.get("chunk_id")) for d in docs) if store else {}
+        out: List[Document] = []
+        for d in docs:
+            own = str(d.metadata.get("source", ""))
+            sources = mapping.get(str(d.metadata.get("chunk_id"))) or [own]
+            meta = {**d.metadata, "sources": sources}
+            if own not in sources:
+                meta["source"] = sources[0]  # source gốc đã bị xoá, chunk còn lại nhờ source khác
+            out.append(Document(page_content=d.page_content, metadata=meta))
+        return out
+
+    # ---- legacy single index → shards ----
+    def _split_legacy_index(self) -> None:
+        """Tách index đơn cũ (<root>/index.faiss) sang shard, dùng lại vector sẵn có (không embed lại)."""
+        if not (self.root / "index.faiss").exists() or self._shards:
+            return
+        legacy = FAISS.load_local(str(self.root), self.embeddings, allow_dangerous_deserialization=True)
+        groups: Dict[str, Tuple[List[Document], List[List[float]], List[str]]] = {}
+        for pos, doc_id in legacy.index_to_docstore_id.items():
+            doc = legacy.docstore.search(doc_id)
+            if not isinstance(doc, Document):
+                continue
+            shard_id = self.shard_for(str(doc.metadata.get("source", "")))
+            docs, vectors, ids = groups.setdefault(shard_id, ([], [], []))
+            docs.append(doc)
+            vectors.append(legacy.index.reconstruct(int(pos)).tolist())
+            ids.append(doc.metadata.get("chunk_id") or doc_id)
+        for shard_id, (docs, vectors, ids) in groups.items():
+            self.add_embedded(shard_id, docs, vectors, ids)
+        self.compact(force=True)
+
+        backup = self.root / "_legacy"
+        backup.mkdir(parents=True, exist_ok=True)
+        for name in ("index.faiss", "index.pkl"):
+            if (self.root / name).exists():
+                shutil.move(str(self.root / name), str(backup / name))
+        print(f"[INFO] Đã tách index cũ thành {len(groups)} shard: {self.root}")
+
+    # ---- properties ----
+    @property
+    def version(self) -> int:
+        """Phiên bản dữ liệu: đổi khi có chunk được thêm/xoá hoặc liên kết source thay đổi."""
+        with self._lock:
+            return self._version
+
+    def _bump_version(self) -> None:
+        with self._lock:
+            self._version += 1
+
+    @property
+    def shard_count(self) -> int:
+        return int(self._manifest["shard_count"])
+
+    @property
+    def ntotal(self) -> int:
+        return sum(s.ntotal for s in list(self._shards.values()))
+
+    @property
+    def dim(self) -> Optional[int]:
+        for s in list(self._shards.values()):
+            if s.dim is not None:
+                return s.dim
+        return None
+
+    def is_empty(self) -> bool:
+        return self.ntotal == 0
+
+    def source_shards(self) -> Dict[str, str]:
+        """source (lowercase) → shard_id."""
+        with self._lock:
+            return dict(self._manifest["sources"])
+
+    def indexed_sources(self) -> set:
+        """Mọi source (lowercase) đang có nội dung trong index, kể cả source chỉ còn nhờ dedup-link."""
+        with self._lock:
+            out = set(self._manifest["sources"]) | set(self._manifest["links"])
+        store = self._fingerprint_store(create=False)
+        if store is not None:
+            out.update(src.lower() for src in store.all_sources())
+        return out
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "shard_count": self.shard_count,
+            "shards": {sid: s.ntotal for sid, s in sorted(self._shards.items())},
+            "delta": {sid: s.delta_stats() for sid, s in sorted(self._shards.items()) if any(s.delta_stats().values())},
+            "sources": len(self._manifest["sources"]),
+            "two_stage": self.two_stage,
+            "fingerprints_backfilled": self._backfill_done.is_set(),
+        }
+
+    def memory_stats(self) -> Dict[str, int]:
+        """
+        Ước tính số byte vector dense (n·d·4 cho float32, n·d'·2 cho fp16), không phải số đo RSS:
+        bản đầy đủ, bản giảm chiều, và phần được giữ trong RAM.
+        """
+        total = {"full_f32": 0, "reduced_f16": 0, "resident_dense": 0}
+        for s in list(self._shards.values()):
+            for key, val in s.memory_bytes().items():
+                total[key] += val
+        return total
+
+    # ---- writes ----
+    def add_embedded(self, shard_id: str, docs: List[Document], vectors: List[List[float]],
+                     ids: Optional[List[str]] = None) -> int:
+        """Ghi chunk đã có vector vào một shard cụ thể (giữ nguyên id docstore nếu truyền vào)."""
+        if not docs:
+            return 0
+        shard = self._get_shard(shard_id)
+        shard.add(docs, vectors, ids)
+        with self._lock:
+            for d in docs:
+                self._manifest["sources"][str(d.metadata.get("source", "")).lower()] = shard_id
+            self._write_manifest()
+            self._version += 1
+        self._maybe_compact(shard)
+        return len(docs)
+
+    def add_documents(self, docs: List[Document], group: Optional[str] = None,
+                      shard_id: Optional[str] = None) -> Dict[str, int]:
+        """
+        Dedup → embed → ghi. Chunk trùng tuyệt đối hoặc gần trùng (SimHash) với chunk đã có
+        (trong index hoặc cùng batch) không được embed; source của nó được gắn vào chunk cũ.
+        """
+        stats = {"added": 0, "deduplicated": 0, "exact_duplicates": 0, "near_duplicates": 0}
+        if not docs:
+            return stats
+        store = self._fingerprint_store()
+
+        fresh: List[Tuple[Document, str, str, str, Optional[int]]] = []  # (doc, id, shard, exact, simhash)
+        links: List[Tuple[str, str, str]] = []  # (chunk_id giữ lại, shard của nó, source mới)
+        batch = BatchFingerprints()
+        for d in docs:
+            source = str(d.metadata.get("source", ""))
+            target = shard_id or self.shard_for(source, group)
+            exact, sim = fingerprint(d.page_content)
+            hit = store.find(exact, sim) if DEDUP_ENABLED else None
+            if hit is None and DEDUP_ENABLED:
+                hit = batch.find(exact, sim)
+            if hit is not None:
+                links.append((hit[0], hit[1], source))
+                stats["exact_duplicates" if hit[2] == "exact" else "near_duplicates"] += 1
+                continue
+            chunk_id = str(d.metadata.get("chunk_id") or uuid.uuid4())
+            fresh.append((d, chunk_id, target, exact, sim))
+            batch.add(chunk_id, target, exact, sim)
+
+        if fresh:
+            # Embed ngoài lock (gọi mạng chậm), chỉ khoá shard khi ghi vector
+            vectors = self.embeddings.embed_documents([d.page_content for d, *_ in fresh])
+            by_shard: Dict[str, Tuple[List[Document], List[List[float]], List[str]]] = {}
+            for (d, chunk_id, target, _, _), v in zip(fresh, vectors):
+                bucket = by_shard.setdefault(target, ([], [], []))
+                bucket[0].append(d)
+                bucket[1].append(v)
+                bucket[2].append(chunk_id)
+            for target, (shard_docs, shard_vectors, ids) in by_shard.items():
+                self.add_embedded(target, shard_docs, shard_vectors, ids)
+            store.register(
+                (chunk_id, exact, sim, target, str(d.metadata.get("source", "")))
+                for d, chunk_id, target, exact, sim in fresh
+            )
+
+        if links:
+            store.link((chunk_id, source) for chunk_id, _, source in links)
+            with self._lock:
+                for _, kept_shard, source in links:
+                    key = source.lower()
+                    if self._manifest["sources"].get(key) != kept_shard:
+                        shards = self._manifest["links"].setdefault(key, [])
+                        if kept_shard not in shards:
+                            shards.append(kept_shard)
+                self._write_manifest()
+                self._version += 1
+
+        stats["added"] = len(fresh)
+        stats["deduplicated"] = stats["exact_duplicates"] + stats["near_duplicates"]
+        return stats
+
+    def delete_ids(self, ids: Iterable[str]) -> int:
+        ids = set(ids)
+        removed = 0
+        for shard_id, s in list(self._shards.items()):
+            touched = {str(d.metadata.get("source", "")).lower() for doc_id, d in s.items() if doc_id in ids}
+            n = s.delete_ids(ids)
+            if not n:
+                continue
+            removed += n
+            # Bỏ routing của source không còn chunk nào trong shard
+            left = {str(d.metadata.get("source", "")).lower() for d in s.documents()}
+            with self._lock:
+                for src in touched - left:
+                    if self._manifest["sources"].get(src) == shard_id:
+                        del self._manifest["sources"][src]
+                self._write_manifest()
+            self._maybe_compact(s)
+        if removed:
+            store = self._fingerprint_store(create=False)
+            if store is not None:
+                store.remove_chunks(ids)
+            self._bump_version()
+        return removed
+
+    def delete_source(self, source: str) -> int:
+        """Gỡ source; chunk vẫn còn source khác trỏ tới (do dedup) được giữ lại."""
+        with self._lock:
+            shard_id = self._manifest["sources"].pop(source.lower(), None)
+            self._manifest["links"].pop(source.lower(), None)
+            shard = self._shards.get(shard_id) if shard_id else None
+            self._write_manifest()
+
+        store = self._fingerprint_store(create=False)
+        if store is None:
+            if shard is None:
+                return 0
+            removed = shard.delete_source(source)
+            self._maybe_compact(shard)
+            self._bump_version()
+            return removed
+
+        removed = 0
+        orphans: Dict[str, List[str]] = {}
+        for chunk_id, owner in store.remove_source(source):
+            orphans.setdefault(owner, []).append(chunk_id)
+        if shard is not None and not self._backfill_done.is_set():
+            # Backfill chưa xong: chunk của source này có thể chưa có trong store
+            own = [doc_id for doc_id, d in shard.items() if d.metadata.get("source") == source]
+            unknown = set(own) - store.known(own)
+            if unknown:
+                orphans.setdefault(shard.shard_id, []).extend(unknown)
+        for owner, ids in orphans.items():
+            s = self._shards.get(owner)
+            if s is not None:
+                removed += s.delete_ids(ids)
+                self._maybe_compact(s)
+        self._bump_version()
+        return removed
+
+    # ---- compaction ----
+    def _maybe_compact(self, shard: _Shard) -> None:
+        if shard.needs_compaction():
+            _COMPACT_POOL.submit(self._compact_shard, shard)
+
+    def _compact_shard(self, shard: _Shard) -> bool:
+        try:
+            return shard.compact()
+        except Exception as e:
+            print(f"[WARN] Compaction shard {shard.shard_id} lỗi: {e}")
+            return False
+
+    @staticmethod
+    def wait_for_compaction() -> None:
+        """Chờ các compaction nền đã xếp hàng chạy xong (worker đơn, FIFO)."""
+        _COMPACT_POOL.submit(lambda: None).result()
+
+    def compact(self, force: bool = False) -> List[str]:
+        """Gộp delta vào base (đồng bộ). force=False: chỉ các shard vượt ngưỡng."""
+        shards = [s for s in list(self._shards.values()) if force or s.needs_compaction()]
+        return [s.shard_id for s in shards if self._compact_shard(s)]
+
+    # ---- reads ----
+    def iter_documents(self) -> Iterable[Tuple[str, str, Document]]:
+        """(shard_id, docstore_id, Document) của toàn bộ index."""
+        for shard_id, s in sorted(self._shards.items()):
+            for doc_id, d in s.items():
+                yield shard_id, doc_id, d
+
+    def all_documents(self) -> List[Document]:
+        out: List[Document] = []
+        for s in list(self._shards.values()):
+            out.extend(s.documents())
+        return out
+
+    @contextmanager
+    def full_precision_baseline(self):
+        """
+        Trong khối này, dense mode "full" dùng IndexFlatL2 đầy đủ nạp từ index.faiss của từng
+        shard (đúng đường search khi tắt two-stage). Tốn RAM bằng toàn bộ vector, chỉ dùng cho eval.
+        """
+        shards = list(self._shards.values())
+        try:
+            for s in shards:
+                s.load_baseline()
+            yield
+        finally:
+            for s in shards:
+                s.release_baseline()
+
+    def dense_search(self, vector: List[float], k: int = 4, mode: str = "auto",
+                     source_in: Optional[List[str]] = None) -> List[Document]:
+        """Chỉ phần dense, với vector query có sẵn (eval dùng để so full vs two-stage)."""
+        shards = self._route(source_in)
+        futures = [_SEARCH_POOL.submit(s.dense_search, vector, k, mode) for s in shards]
+        hits: List[Tuple[Document, float]] = []
+        for fut in futures:
+            hits.extend(fut.result())
+        hits.sort(key=lambda x: x[1])
+        return self._with_sources([d for d, _ in hits[:k]])
+
+    def search(self, query: str, k: int = 4, source_in: Optional[List[str]] = None,
+               mode: str = "auto") -> List[Document]:
+        """
+        Hybrid search (FAISS + BM25) trên các shard liên quan.
+        Mỗi shard trả top-k dense/lexical; gộp toàn cục theo score rồi RRF như trước.
+        BM25 của các shard được search dùng chung thống kê (N, df, avgdl) cộng dồn của
+        chính các shard đó, nên điểm giữa các shard so sánh được. Chỉ khoá đọc các shard
+        được route tới: ghi vào shard khác không chặn search này.
+        """
+        shards = self._route(source_in)
+        if not shards:
+            return []
+        per_k = max(k, 4)
+        vector = self.embeddings.embed_query(query)
+        terms = _bm25_tokens(query)
+        stats_futures = [_SEARCH_POOL.submit(s.lexical_stats, terms) for s in shards]
+        lex_stats = _merge_lex_stats(f.result() for f in stats_futures)
+        futures = [_SEARCH_POOL.submit(s.search, query, vector, per_k, mode, lex_stats) for s in shards]
+
+        dense: List[Tuple[Document, float]] = []
+        lexical: List[Tuple[Document, float]] = []
+        for fut in futures:
+            d, lx = fut.result()
+            dense.extend(d)
+            lexical.extend(lx)
+        dense.sort(key=lambda x: x[1])           # L2 distance: nhỏ hơn = gần hơn
+        lexical.sort(key=lambda x: x[1], reverse=True)
+        return self._with_sources(_weighted_rrf(
+            [[d for d, _ in dense[:per_k]], [d for d, _ in lexical[:per_k]]],
+            HYBRID_WEIGHTS,
+        ))
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+from typing import Optional, List, Tuple, Dict, Any, Callable
+from pathlib import Path
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from rag_data import build_embeddings
+from rag_index import ShardedIndex
+
+MIGRATE_BATCH_SIZE = int(os.getenv("EMB_MIGRATE_BATCH_SIZE", "64"))
+MIGRATE_MAX_RPM = float(os.getenv("EMB_MIGRATE_MAX_RPM", "60"))  # số batch embed tối đa mỗi phút
+MIGRATE_MAX_RETRIES = int(os.getenv("EMB_MIGRATE_MAX_RETRIES", "5"))
+
+__all__ = [
+    "EmbeddingMigration",
+]
+
+# (shard_id, docstore_id, Document)
+_Pending = List[Tuple[str, str, Document]]
+
+class EmbeddingMigration:
+    """
+    Re-embed toàn bộ chunk của index đang phục vụ sang model mới, chạy nền theo batch.
+
+    - Text lấy từ docstore của index hiện tại (không convert lại tài liệu gốc).
+    - Index đích dùng lại shard_id + docstore_id của nguồn, nên chạy lại (resume)
+      chỉ embed những chunk còn thiếu.
+    - Giới hạn tốc độ theo số batch/phút, retry có backoff khi API lỗi.
+    - Khi đã đủ: giữ `write_lock` (chặn ingest), bù phần chênh lệch cuối cùng rồi
+      gọi `on_complete(model, embeddings, index)` để server chuyển traffic.
+    """
+
+    def __init__(
+        self,
+        source: ShardedIndex,
+        target_model: str,
+        target_dir: str,
+        write_lock: threading.Lock,
+        on_complete: Callable[[str, Embeddings, ShardedIndex], None],
+        batch_size: int = MIGRATE_BATCH_SIZE,
+        max_rpm: float = MIGRATE_MAX_RPM,
+    ):
+        self.source = source
+        self.target_model = target_model
+        self.target_dir = Path(target_dir)
+        self.write_lock = write_lock
+        self.on_complete = on_complete
+        self.batch_size = max(1, batch_size)
+        self.min_interval = 60.0 / max_rpm if max_rpm > 0 else 0.0
+        self.state_path = self.target_dir / "migration.json"
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._state_lock = threading.Lock()
+        self._state: Dict[str, Any] = {
+            "source_model": getattr(source.embeddings, "model", None),
+            "target_model": target_model,
+            "target_dir": str(self.target_dir),
+            "status": "pending",
+            "total": source.ntotal,
+            "done": 0,
+            "batches": 0,
+            "error": None,
+            "started_at": None,
+            "updated_at": None,
+        }
+
+    # ---- state ----
+    def _update(self, **fields: Any) -> None:
+        with self._state_lock:
+            self._state.update(fields, updated_at=datetime.utcnow().isoformat())
+            self.target_dir.mkdir(parents=True, exist_ok=True)
+            tmp = self.state_path.with_suffix(".json.tmp")
+            tmp.write_text(json.dumps(self._state, ensure_ascii=False, indent=2), encoding="utf-8")
+            os.replace(tmp, self.state_path)
+
+    def status(self) -> Dict[str, Any]:
+        with self._state_lock:
+            st = dict(self._state)
+        st["percent"] = round(100.0 * st["done"] / st["total"], 2) if st["total"] else 100.0
+        return st
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    # ---- control ----
+    def start(self) -> None:
+        if self.is_running():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="emb-migration", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    # ---- worker ----
+    def _pending(self, target: ShardedIndex) -> Tuple[_Pending, List[str]]:
+        """Chunk nguồn chưa có ở đích, và id ở đích không còn ở nguồn (đã bị xoá/ghi đè)."""
+        source_items = list(self.source.iter_documents())
+        source_ids = {doc_id for _, doc_id, _ in source_items}
+        target_ids = {doc_id for _, doc_id, _ in target.iter_documents()}
+        missing = [item for item in source_items if item[1] not in target_ids]
+        stale = [doc_id for doc_id in target_ids if doc_id not in source_ids]
+        return missing, stale
+
+    def _embed_with_retry(self, embeddings: Embeddings, texts: List[str]) -> List[List[float]]:
+        for attempt in range(MIGRATE_MAX_RETRIES):
+            try:
+                return embeddings.embed_documents(texts)
+            except Exception as e:
+                if attempt == MIGRATE_MAX_RETRIES - 1:
+                    raise
+                self._update(error=f"retry {attempt + 1}: {e}")
+                self._stop.wait(min(60.0, 2.0 ** attempt))
+        return []
+
+    def _copy(self, target: ShardedIndex, embeddings: Embeddings, pending: _Pending) -> None:
+        # Gom theo shard để mỗi batch chỉ ghi vào một shard
+        by_shard: Dict[str, List[Tuple[str, Document]]] = {}
+        for shard_id, doc_id, doc in pending:
+            by_shard.setdefault(shard_id, []).append((doc_id, doc))
+
+        last = 0.0
+        for shard_id, items in by_shard.items():
+            for i in range(0, len(items), self.batch_size):
+                if self._stop.is_set():
+                    return
+                wait = self.min_interval - (time.monotonic() - last)
+                if wait > 0 and self._stop.wait(wait):
+                    return
+                last = time.monotonic()
+
+                batch = items[i:i + self.batch_size]
+                vectors = self._embed_with_retry(embeddings, [d.page_content for _, d in batch])
+                target.add_embedded(shard_id, [d for _, d in batch], vectors, [doc_id for doc_id, _ in batch])
+                with self._state_lock:
+                    done, batches = self._state["done"] + len(batch), self._state["batches"] + 1
+                self._update(done=done, batches=batches, error=None)
+
+    def _run(self) -> None:
+        try:
+            embeddings = build_embeddings(self.target_model)
+            target = ShardedIndex(str(self.target_dir), embeddings, shard_count=self.source.shard_count)
+            self._update(status="running", started_at=datetime.utcnow().isoformat(),
+                         done=target.ntotal, total=self.source.ntotal)
+
+            # Các lượt không khoá: ingest mới trong lúc chạy sẽ được lượt sau bắt kịp
+            while not self._stop.is_set():
+                missing, _ = self._pending(target)
+                self._update(total=self.source.ntotal)
+                if not missing:
+                    break
+                self._copy(target, embeddings, missing)
+            if self._stop.is_set():
+                self._update(status="stopped")
+                return
+
+            # Lượt cuối: chặn ghi, bù chênh lệch rồi chuyển traffic
+            with self.write_lock:
+                missing, stale = self._pending(target)
+                self._copy(target, embeddings, missing)
+                if self._stop.is_set():
+                    self._update(status="stopped")
+                    return
+                target.delete_ids(stale)
+                target.copy_fingerprints_from(self.source)
+                self.on_complete(self.target_model, embeddings, target)
+            self._update(status="completed", done=target.ntotal, total=target.ntotal)
+        except Exception as e:
+            self._update(status="failed", error=str(e))
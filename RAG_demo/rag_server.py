@@ -1,18 +1,16 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any
 from datetime import datetime
 import time
+import threading
 import os, io, re, csv, json, shutil, uuid
 from pathlib import Path
 
 from dotenv import load_dotenv
 load_dotenv()
 
-from langchain_community.vectorstores import FAISS
-from langchain.retrievers import EnsembleRetriever
-from langchain_community.retrievers import BM25Retriever
 from langchain_core.documents import Document
 from langchain_google_genai import (
     ChatGoogleGenerativeAI,
@@ -22,12 +20,17 @@ from langchain_google_genai import (
 # Ingest helpers
 from rag_data import (
     load_data_from_folder,
-    build_or_load_faiss,
     DEFAULT_INDEX_DIR,
     route_and_chunk_text,
-    _docling_markdown_from_path,
     apply_metadata_quality_gate,
+    build_embeddings,
+    extract_text,
+    load_data_from_conversion_cache,
+    forget_cached_sources,
 )
+from rag_index import ShardedIndex
+from rag_migrate import EmbeddingMigration
+from rag_singleflight import SingleFlight, coalesce_key
 
 ALLOWED_EXTS = {".pdf", ".docx", ".pptx", ".html", ".htm", ".png", ".jpg", ".jpeg", ".tif", ".tiff", ".txt", ".md"}
 
@@ -40,12 +43,35 @@ if not GOOGLE_API_KEY:
 # - "models/text-embedding-004" (≈3072 dims)
 # - "models/embedding-001" (≈768 dims)
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
-EMB_MODEL = os.getenv("GEMINI_EMB_MODEL", "models/text-embedding-004")
+ENV_EMB_MODEL = os.getenv("GEMINI_EMB_MODEL", "models/text-embedding-004")
+# Tự chạy migration khi GEMINI_EMB_MODEL khác model đang phục vụ
+MIGRATE_ON_START = os.getenv("EMB_MIGRATE_ON_START", "1").lower() in {"1", "true", "yes"}
 
 # Tách thư mục index theo tên model để tránh đụng độ
 BASE_INDEX_DIR = os.getenv("FAISS_INDEX_DIR", DEFAULT_INDEX_DIR)
+# Model đang phục vụ được ghi lại ở đây; chỉ đổi khi migration hoàn tất
+ACTIVE_MODEL_FILE = Path(BASE_INDEX_DIR) / "active_model.json"
+
+def _model_index_dir(model: str) -> str:
+    return str(Path(BASE_INDEX_DIR) / model.replace("/", "_"))
+
+def _read_active_model() -> Optional[str]:
+    try:
+        return json.loads(ACTIVE_MODEL_FILE.read_text(encoding="utf-8")).get("model")
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def _write_active_model(model: str) -> None:
+    ACTIVE_MODEL_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = ACTIVE_MODEL_FILE.with_suffix(".json.tmp")
+    tmp.write_text(json.dumps({"model": model, "ts": datetime.utcnow().isoformat()}), encoding="utf-8")
+    os.replace(tmp, ACTIVE_MODEL_FILE)
+
+EMB_MODEL = _read_active_model() or ENV_EMB_MODEL
+if not ACTIVE_MODEL_FILE.exists():
+    _write_active_model(EMB_MODEL)
 MODEL_SAFE = EMB_MODEL.replace("/", "_")
-INDEX_DIR = str(Path(BASE_INDEX_DIR) / MODEL_SAFE)
+INDEX_DIR = _model_index_dir(EMB_MODEL)
 
 # Logging / Eval paths
 LOG_DIR = Path("./_logs"); LOG_DIR.mkdir(parents=True, exist_ok=True)
@@ -63,7 +89,17 @@ app.add_middleware(
 )
 
 # ---------- GLOBAL STATE ----------
-vector_store: Optional[FAISS] = None
+vector_store: Optional[ShardedIndex] = None
+migration: Optional[EmbeddingMigration] = None
+# Ingest / reset / chuyển model không chạy chồng lên nhau
+_write_lock = threading.Lock()
+# Kiểm tra + khởi động migration là một bước (tránh hai worker cùng ghi một thư mục đích)
+_migration_lock = threading.Lock()
+# /search, /chat trùng nhau đang chạy đồng thời chỉ tính một lần
+single_flight = SingleFlight()
+# Số lời gọi thực sự ra Gemini (để đo hiệu quả gộp request)
+_upstream_calls = {"embed_query": 0, "llm": 0}
+_upstream_lock = threading.Lock()
 
 # Khởi tạo LLM / Embeddings
 llm = ChatGoogleGenerativeAI(
@@ -74,28 +110,47 @@ emb = GoogleGenerativeAIEmbeddings(
 )
 
 # ---------- Utilities ----------
+def _count_upstream(name: str) -> None:
+    with _upstream_lock:
+        _upstream_calls[name] += 1
+
+def _index_version(vs: ShardedIndex) -> str:
+    # Đổi khi ghi dữ liệu, reset index hoặc chuyển model → không gộp với kết quả của index cũ
+    return f"{INDEX_DIR}:{id(vs)}:{vs.version}"
+
+_EMB_DIMS: Dict[str, int] = {}
+
+def get_emb_dim(embeddings: Any) -> int:
+    model = getattr(embeddings, "model", EMB_MODEL)
+    if model not in _EMB_DIMS:
+        _EMB_DIMS[model] = len(embeddings.embed_query("dim-probe"))
+    return _EMB_DIMS[model]
+
 def get_current_emb_dim() -> int:
-    vec = emb.embed_query("dim-probe")
-    return len(vec)
+    return get_emb_dim(emb)
 
 EXPECTED_DIM = get_current_emb_dim()
 
-def ensure_index_compatible(vs: Optional[FAISS]) -> Optional[str]:
+def ensure_index_compatible(vs: Optional[ShardedIndex]) -> Optional[str]:
     try:
-        if vs is None:
+        if vs is None or vs.dim is None:
             return None
-        faiss_dim = int(vs.index.d) 
-        if faiss_dim != EXPECTED_DIM:
-            return (f"FAISS index dim = {faiss_dim} khác với embedding dim = {EXPECTED_DIM}. "
+        faiss_dim = vs.dim
+        # So với embeddings đi kèm index (không phải global) để an toàn khi đang chuyển model
+        expected_dim = get_emb_dim(vs.embeddings)
+        if faiss_dim != expected_dim:
+            return (f"FAISS index dim = {faiss_dim} khác với embedding dim = {expected_dim}. "
                     f"Có thể do đổi model embeddings ({EMB_MODEL}). "
-                    f"Hãy xoá index cũ bằng POST /reset_index rồi ingest lại.")
+                    f"Hãy chạy POST /migrate_embeddings, hoặc xoá index cũ bằng POST /reset_index rồi ingest lại.")
         return None
     except Exception as e:
         return f"Không đọc được dimension của FAISS index: {e}"
 
-def load_index_if_exists() -> Optional[FAISS]:
+def load_index_if_exists() -> Optional[ShardedIndex]:
     try:
-        vs = build_or_load_faiss([], index_dir=INDEX_DIR)
+        vs = ShardedIndex(INDEX_DIR, emb)
+        if vs.is_empty():
+            return None
         msg = ensure_index_compatible(vs)
         if msg:
             raise ValueError(msg)
@@ -104,21 +159,11 @@ def load_index_if_exists() -> Optional[FAISS]:
         return None
 
 # ---------- Hybrid Retriever ----------
-def _all_docs_from_faiss(vs: FAISS, max_docs: int = 5000) -> List[Document]:
-    try:
-        values = list(getattr(vs.docstore, "_dict", {}).values())
-        if not values:
-            values = vs.similarity_search(" ", k=min(1024, max_docs))
-        return values[:max_docs]
-    except Exception:
-        return []
-
-def make_hybrid_retriever(vs: FAISS, k: int = 4) -> EnsembleRetriever:
-    retriever_faiss = vs.as_retriever(search_type="similarity", search_kwargs={"k": max(k, 4)})
-    corpus_docs = _all_docs_from_faiss(vs)
-    bm25 = BM25Retriever.from_documents(corpus_docs) if corpus_docs else BM25Retriever.from_documents([])
-    bm25.k = max(k, 4)
-    return EnsembleRetriever(retrievers=[retriever_faiss, bm25], weights=[0.5, 0.5])
+def hybrid_search(vs: ShardedIndex, query: str, k: int = 4,
+                  source_in: Optional[List[str]] = None) -> List[Document]:
+    # FAISS + BM25 theo từng shard, chỉ các shard chứa source_in (nếu có)
+    _count_upstream("embed_query")  # query được embed đúng một lần cho mọi shard
+    return vs.search(query, k=k, source_in=source_in)
 
 # ---------- Metadata filters ----------
 def _meta_match(d: Document, contains: Dict[str, Any]) -> bool:
@@ -139,7 +184,11 @@ def _apply_filters(
 
     if source_in:
         source_set = set(s.lower() for s in source_in)
-        docs = [d for d in docs if str(d.metadata.get("source", "")).lower() in source_set]
+        # Chunk đã dedup mang danh sách mọi source chứa nó
+        docs = [
+            d for d in docs
+            if any(str(s).lower() in source_set for s in (d.metadata.get("sources") or [d.metadata.get("source", "")]))
+        ]
 
     if section_title_regex:
         try:
@@ -160,7 +209,7 @@ def _build_context(docs: List[Document]) -> str:
         for d in docs
     )
 
-def chat_with_context(vs: FAISS, query: str, k: int = 4,
+def chat_with_context(vs: ShardedIndex, query: str, k: int = 4,
                       min_quality_tier: str = "medium",
                       include_low: bool = False,
                       source_in: Optional[List[str]] = None,
@@ -171,12 +220,11 @@ def chat_with_context(vs: FAISS, query: str, k: int = 4,
     if msg:
         return {"error": msg}
 
-    retr = make_hybrid_retriever(vs, k=k)
     # Chiến lược "coarse-to-fine": tăng k nếu sau filter không đủ ngữ cảnh
     coarse_k = k
     docs: List[Document] = []
     for _ in range(max_retry_coarse + 1):
-        docs = retr.invoke(query) if hasattr(retr, "invoke") else retr.get_relevant_documents(query)
+        docs = hybrid_search(vs, query, k=coarse_k, source_in=source_in)
         docs = _apply_filters(
             docs,
             min_quality_tier=min_quality_tier,
@@ -188,7 +236,6 @@ def chat_with_context(vs: FAISS, query: str, k: int = 4,
         if len(docs) >= min(k, 3):
             break
         coarse_k = min(20, coarse_k + k)
-        retr = make_hybrid_retriever(vs, k=coarse_k)
 
     if not docs:
         return {"answer": "Tôi không chắc chắn về tài liệu được cung cấp.", "contexts": []}
@@ -203,6 +250,7 @@ def chat_with_context(vs: FAISS, query: str, k: int = 4,
         f"Câu hỏi: {query}\n"
         f"Yêu cầu: Trả lời bằng tiếng Việt, bám sát ngữ cảnh."
     )
+    _count_upstream("llm")
     resp = llm.invoke([("system", system), ("human", user_msg)])
     answer = getattr(resp, "content", str(resp))
     return {
@@ -219,6 +267,7 @@ def chat_with_context(vs: FAISS, query: str, k: int = 4,
 class IngestFolderIn(BaseModel):
     folder: str = "data"
     force_rebuild: bool = False
+    group: Optional[str] = None  # vd: id study set → gom vào cùng một shard
 
 class SearchIn(BaseModel):
     query: str
@@ -241,31 +290,52 @@ class EvalIn(BaseModel):
     k: int = 4
     eval_file: Optional[str] = None  # path custom; mặc định ./eval/eval.jsonl
 
+class MigrateIn(BaseModel):
+    target_model: Optional[str] = None  # mặc định: GEMINI_EMB_MODEL trong .env
+    batch_size: Optional[int] = None
+    max_rpm: Optional[float] = Field(default=None, description="Số batch embed tối đa mỗi phút")
+
 # ---------- Routes ----------
 @app.get("/health")
 def health():
-    return {"ok": True, "emb_model": EMB_MODEL, "emb_dim": EXPECTED_DIM, "index_dir": INDEX_DIR}
+    return {
+        "ok": True, "emb_model": EMB_MODEL, "emb_dim": EXPECTED_DIM, "index_dir": INDEX_DIR,
+        "index": vector_store.stats() if vector_store is not None else None,
+        "migration": migration.status() if migration is not None else None,
+        "coalescing": _coalescing_stats(),
+    }
 
 @app.get("/")
 def root():
     return {
         "ok": True,
         "message": "RAG Test API is running.",
-        "endpoints": ["/health", "/ingest_folder", "/ingest_file", "/search", "/chat", "/reset_index", "/feedback", "/eval_offline"]
+        "endpoints": ["/health", "/ingest_folder", "/ingest_file", "/search", "/chat", "/reset_index", "/feedback", "/eval_offline",
+                      "/migrate_embeddings", "/migrate_status", "/migrate_stop", "/compact_index",
+                      "/reindex_from_cache", "/coalesce_stats"]
     }
 
-@app.post("/reset_index")
-def reset_index():
-    """Xoá toàn bộ thư mục INDEX_DIR của model embeddings hiện tại. (Không xoá ./_uploads)"""
+def _reset_index_locked() -> None:
+    global vector_store
+    if migration is not None:
+        migration.stop()
+    if vector_store is not None:
+        vector_store.close()
     p = Path(INDEX_DIR)
     if p.exists():
         shutil.rmtree(p, ignore_errors=True)
-    global vector_store
     vector_store = None
+
+@app.post("/reset_index")
+def reset_index():
+    """Xoá toàn bộ thư mục INDEX_DIR của model embeddings hiện tại. (Không xoá ./_uploads)"""
+    with _write_lock:
+        _reset_index_locked()
+        forget_cached_sources()  # reindex_from_cache không dựng lại tài liệu đã xoá
     return {"ok": True, "message": f"Đã xoá index: {INDEX_DIR}"}
 
 @app.post("/ingest_file")
-def ingest_file(file: UploadFile = File(...)):
+def ingest_file(file: UploadFile = File(...), group: Optional[str] = Form(None)):
     global vector_store
     ext = Path(file.filename).suffix.lower()
     if ext not in ALLOWED_EXTS:
@@ -278,12 +348,9 @@ def ingest_file(file: UploadFile = File(...)):
     with open(tmp_path, "wb") as f:
         f.write(file.file.read())
 
-    # Extract text based on file type
+    # Extract text based on file type (cache theo hash nội dung → upload lại không convert lại)
     try:
-        if ext in {".txt", ".md"}:
-            text = tmp_path.read_text(encoding="utf-8", errors="ignore")
-        else:
-            text = _docling_markdown_from_path(str(tmp_path))
+        text = extract_text(str(tmp_path), source=file.filename)
     except Exception as e:
         return {"ok": False, "error": f"Failed to process file {file.filename}: {str(e)}"}
 
@@ -292,48 +359,132 @@ def ingest_file(file: UploadFile = File(...)):
     if not chunks:
         return {"ok": False, "error": "Không trích xuất được nội dung tài liệu."}
 
-    # Load existing vector store if available
-    if vector_store is None:
-        vector_store = load_index_if_exists()
+    with _write_lock:
+        # Load existing vector store if available
+        if vector_store is None:
+            vector_store = load_index_if_exists() or ShardedIndex(INDEX_DIR, emb)
 
-    # Remove existing documents with the same source
-    if vector_store is not None:
+        # Remove existing documents with the same source (chỉ khoá shard chứa file đó)
         try:
-            # Get all documents in the current FAISS index
-            existing_docs = _all_docs_from_faiss(vector_store)
-            docs_to_remove = [d for d in existing_docs if d.metadata.get("source") == file.filename]
-
-            if docs_to_remove:
-                # Get chunk IDs to remove
-                chunk_ids_to_remove = [d.metadata.get("chunk_id") for d in docs_to_remove]
-                # Remove documents from FAISS index
-                vector_store.delete(chunk_ids_to_remove)
-                vector_store.save_local(INDEX_DIR)
-                print(f"[INFO] Removed {len(docs_to_remove)} existing chunks for {file.filename}")
+            removed = vector_store.delete_source(file.filename)
+            if removed:
+                print(f"[INFO] Removed {removed} existing chunks for {file.filename}")
         except Exception as e:
             print(f"[WARN] Failed to remove existing documents for {file.filename}: {e}")
 
-    # Add new chunks to the FAISS index
-    vector_store = build_or_load_faiss(chunks, index_dir=INDEX_DIR)
+        # Add new chunks to the shard of this source (chunk trùng chỉ được gắn thêm source)
+        try:
+            added = vector_store.add_documents(chunks, group=group)
+        except Exception as e:
+            # Bản cũ đã bị gỡ, bản mới không vào được index → gỡ luôn khỏi conversion cache
+            if file.filename.lower() not in vector_store.indexed_sources():
+                forget_cached_sources([file.filename])
+            return {"ok": False, "error": f"Failed to index file {file.filename}: {str(e)}"}
 
     # Verify index compatibility
     msg = ensure_index_compatible(vector_store)
     if msg:
         return {"ok": False, "error": msg}
 
-    return {"ok": True, "file": file.filename, "added_chunks": len(chunks), "index_dir": INDEX_DIR}
+    return {
+        "ok": True, "file": file.filename, "added_chunks": added["added"],
+        "deduplicated": added["deduplicated"], "near_duplicates": added["near_duplicates"],
+        "index_dir": INDEX_DIR,
+    }
+
+@app.post("/compact_index")
+def compact_index():
+    """Gộp delta segment (chunk mới + tombstone) của mọi shard vào base index ngay lập tức."""
+    err = _ensure_vs_ready()
+    if err:
+        return err
+    t0 = time.time()
+    compacted = vector_store.compact(force=True)  # type: ignore[union-attr]
+    return {"ok": True, "compacted_shards": compacted, "latency_ms": int((time.time() - t0) * 1000)}
+
+@app.post("/reindex_from_cache")
+def reindex_from_cache():
+    """
+    Chunk lại + embed lại toàn bộ corpus chỉ từ conversion cache (không chạy docling).
+    Index mới được dựng ở thư mục tạm rồi hoán đổi; /search và /chat vẫn dùng index cũ
+    trong lúc dựng, chỉ ingest bị chặn.
+    """
+    global vector_store
+    t0 = time.time()
+    with _write_lock:
+        # Sau restart vector_store còn None: mở index trên đĩa (kể cả khi khác dim với model
+        # hiện tại, vì reindex sẽ dựng lại) để kiểm tra source và giữ shard bên dưới
+        if vector_store is None:
+            try:
+                vector_store = ShardedIndex(INDEX_DIR, emb)
+            except Exception as e:
+                return {"ok": False, "error": f"Không đọc được index hiện tại ({INDEX_DIR}): {e}"}
+        # Chỉ dựng lại source đang có trong index (không hồi sinh tài liệu đã reset/xoá)
+        chunks = load_data_from_conversion_cache(vector_store.indexed_sources())
+        if not chunks:
+            return {"ok": False, "error": "Không có tài liệu đã index nào trong conversion cache, hãy ingest tài liệu trước."}
+        # Source đã index nhưng không còn bản convert trong cache (index trước khi có cache,
+        # hoặc đã bị evict) sẽ mất khỏi index sau khi hoán đổi → từ chối thay vì âm thầm xoá
+        rebuilt = {str(c.metadata.get("source", "")).lower() for c in chunks}
+        missing = sorted(vector_store.indexed_sources() - rebuilt)
+        if missing:
+            return {
+                "ok": False,
+                "error": "Một số tài liệu đã index không có trong conversion cache; hãy ingest lại chúng trước khi reindex.",
+                "missing_sources": missing,
+            }
+        if migration is not None:
+            migration.stop()
+        # Giữ nguyên shard của từng source (vd: shard theo study set)
+        old_shards = vector_store.source_shards()
+        tmp_dir = Path(INDEX_DIR + ".rebuild")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        new_vs = ShardedIndex(str(tmp_dir), emb)
+        by_shard: Dict[Optional[str], List[Document]] = {}
+        for c in chunks:
+            by_shard.setdefault(old_shards.get(str(c.metadata.get("source", "")).lower()), []).append(c)
+        deduplicated = 0
+        for shard_id, docs in by_shard.items():
+            deduplicated += new_vs.add_documents(docs, shard_id=shard_id)["deduplicated"]
+        new_vs.compact(force=True)
+        ShardedIndex.wait_for_compaction()
+        new_vs.close()  # dừng backfill + đóng SQLite trước khi đổi tên thư mục
+
+        old_dir = Path(INDEX_DIR + ".old")
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if Path(INDEX_DIR).exists():
+            os.rename(INDEX_DIR, old_dir)
+        os.rename(tmp_dir, INDEX_DIR)
+        old_vs, vector_store = vector_store, ShardedIndex(INDEX_DIR, emb)
+        old_vs.close()
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    return {
+        "ok": True, "chunks": len(chunks), "deduplicated": deduplicated,
+        "sources": len({c.metadata.get("source") for c in chunks}), "index_dir": INDEX_DIR, "latency_ms": int((time.time() - t0) * 1000),
+    }
 
 @app.post("/ingest_folder")
 def ingest_folder(inp: IngestFolderIn):
     global vector_store
-    if inp.force_rebuild:
-        reset_index()
     chunks = load_data_from_folder(inp.folder)
-    vector_store = build_or_load_faiss(chunks, index_dir=INDEX_DIR)
+    with _write_lock:
+        if inp.force_rebuild:
+            _reset_index_locked()
+            forget_cached_sources(keep={str(c.metadata.get("source", "")) for c in chunks})
+        if vector_store is None:
+            vector_store = load_index_if_exists() or ShardedIndex(INDEX_DIR, emb)
+        if not chunks and vector_store.is_empty():
+            return {"ok": False, "error": "Không có tài liệu để build FAISS."}
+        added = vector_store.add_documents(chunks, group=inp.group)
     msg = ensure_index_compatible(vector_store)
     if msg:
         return {"ok": False, "error": msg}
-    return {"ok": True, "chunks": len(chunks), "index_dir": INDEX_DIR, "emb_dim": EXPECTED_DIM}
+    return {
+        "ok": True, "chunks": len(chunks), "added_chunks": added["added"],
+        "deduplicated": added["deduplicated"], "near_duplicates": added["near_duplicates"],
+        "index_dir": INDEX_DIR, "emb_dim": EXPECTED_DIM,
+    }
 
 def _ensure_vs_ready() -> Optional[Dict[str, Any]]:
     global vector_store
@@ -359,6 +510,16 @@ def _log_interaction(kind: str, payload: Dict[str, Any]) -> str:
         f.write(json.dumps(record, ensure_ascii=False) + "\n")
     return interaction_id
 
+def _coalescing_stats() -> Dict[str, Any]:
+    with _upstream_lock:
+        upstream = dict(_upstream_calls)
+    return {**single_flight.stats(), "upstream_calls": upstream}
+
+@app.get("/coalesce_stats")
+def coalesce_stats():
+    """Số request /search, /chat được gộp và số lời gọi embeddings/LLM thực sự."""
+    return {"ok": True, **_coalescing_stats()}
+
 @app.post("/search")
 def search(inp: SearchIn):
     err = _ensure_vs_ready()
@@ -366,17 +527,22 @@ def search(inp: SearchIn):
         return err
 
     t0 = time.time()
-    retr = make_hybrid_retriever(vector_store, k=inp.k)  # type: ignore[arg-type]
-    raw_docs = retr.get_relevant_documents(inp.query)
+    vs = vector_store
+    filters = inp.model_dump(exclude={"query", "k"})
+
+    def _run() -> List[Document]:
+        raw_docs = hybrid_search(vs, inp.query, k=inp.k, source_in=inp.source_in)  # type: ignore[arg-type]
+        return _apply_filters(
+            raw_docs,
+            min_quality_tier=inp.min_quality_tier,
+            include_low=inp.include_low,
+            source_in=inp.source_in,
+            section_title_regex=inp.section_title_regex,
+            metadata_contains=inp.metadata_contains,
+        )
 
-    docs = _apply_filters(
-        raw_docs,
-        min_quality_tier=inp.min_quality_tier,
-        include_low=inp.include_low,
-        source_in=inp.source_in,
-        section_title_regex=inp.section_title_regex,
-        metadata_contains=inp.metadata_contains,
-    )
+    key = coalesce_key("search", inp.query, inp.k, filters, _index_version(vs))  # type: ignore[arg-type]
+    docs, coalesced = single_flight.do(key, _run)
 
     results = [{
         "content": d.page_content[:1200],
@@ -389,7 +555,8 @@ def search(inp: SearchIn):
             "latency_ms": int((time.time() - t0) * 1000),
             "query": inp.query,
             "k": inp.k,
-            "filters": inp.model_dump(exclude={"query", "k"}),
+            "filters": filters,
+            "coalesced": coalesced,
             "retrieved_chunk_ids": [d.metadata.get("chunk_id") for d in docs[:inp.k]],
             "sources": list({d.metadata.get("source") for d in docs[:inp.k]}),
         },
@@ -404,15 +571,19 @@ def chat(inp: ChatIn):
         return err
 
     t0 = time.time()
-    out = chat_with_context(
-        vector_store,  
+    vs = vector_store
+    filters = inp.model_dump(exclude={"query", "k"})
+    key = coalesce_key("chat", inp.query, inp.k, filters, _index_version(vs))  # type: ignore[arg-type]
+    # Request trùng đến trong lúc đang gọi Gemini sẽ chờ và dùng chung câu trả lời
+    out, coalesced = single_flight.do(key, lambda: chat_with_context(
+        vs,  # type: ignore[arg-type]
         inp.query, k=inp.k,
         min_quality_tier=inp.min_quality_tier,
         include_low=inp.include_low,
         source_in=inp.source_in,
         section_title_regex=inp.section_title_regex,
         metadata_contains=inp.metadata_contains,
-    )
+    ))
     if "error" in out:
         return {"ok": False, "error": out["error"]}
 
@@ -422,7 +593,8 @@ def chat(inp: ChatIn):
             "latency_ms": int((time.time() - t0) * 1000),
             "query": inp.query,
             "k": inp.k,
-            "filters": inp.model_dump(exclude={"query", "k"}),
+            "filters": filters,
+            "coalesced": coalesced,
             "answer": out["answer"],
             "retrieved_chunk_ids": [ctx["metadata"].get("chunk_id") for ctx in out["contexts"]],
             "sources": list({ctx["metadata"].get("source") for ctx in out["contexts"]}),
@@ -431,6 +603,98 @@ def chat(inp: ChatIn):
 
     return {"ok": True, "answer": out["answer"], "contexts": out["contexts"], "interaction_id": interaction_id}
 
+# ---------- Embedding migration ----------
+def _switch_model(model: str, new_emb: Any, new_index: ShardedIndex) -> None:
+    """Gọi khi đang giữ _write_lock: ghi active_model rồi chuyển traffic sang index mới.
+    Thư mục index của model cũ được giữ lại (có thể quay lại bằng cách sửa active_model.json)."""
+    global EMB_MODEL, MODEL_SAFE, INDEX_DIR, emb, EXPECTED_DIM, vector_store
+    _write_active_model(model)
+    EXPECTED_DIM = get_emb_dim(new_emb)
+    EMB_MODEL, MODEL_SAFE, INDEX_DIR = model, model.replace("/", "_"), _model_index_dir(model)
+    emb = new_emb
+    vector_store = new_index
+    print(f"[INFO] Đã chuyển embeddings sang {model} ({INDEX_DIR})")
+
+def _start_migration(target_model: str, batch_size: Optional[int] = None,
+                     max_rpm: Optional[float] = None) -> Dict[str, Any]:
+    with _migration_lock:
+        return _start_migration_locked(target_model, batch_size, max_rpm)
+
+def _start_migration_locked(target_model: str, batch_size: Optional[int],
+                            max_rpm: Optional[float]) -> Dict[str, Any]:
+    global migration, vector_store
+    if target_model == EMB_MODEL:
+        return {"ok": False, "error": f"Model {target_model} đang được sử dụng."}
+    if migration is not None and migration.is_running():
+        return {"ok": False, "error": "Migration đang chạy.", "status": migration.status()}
+
+    if vector_store is None:
+        # Không dùng load_index_if_exists(): nó trả None cả khi index lỗi/không tương thích,
+        # khi đó chuyển model sẽ bỏ rơi dữ liệu đang có
+        try:
+            current = ShardedIndex(INDEX_DIR, emb)
+        except Exception as e:
+            return {"ok": False, "error": f"Không đọc được index hiện tại ({INDEX_DIR}): {e}"}
+        if current.is_empty():
+            current.close()
+        else:
+            msg = ensure_index_compatible(current)
+            if msg:
+                current.close()
+                return {"ok": False, "error": msg}
+            vector_store = current
+    if vector_store is None:
+        # Chưa có dữ liệu để re-embed → chuyển model ngay
+        new_emb = build_embeddings(target_model)
+        target_dir = Path(_model_index_dir(target_model))
+        with _write_lock:
+            # Thư mục đích có thể còn index cũ của model này (từ lần dùng trước) → không khớp
+            # với corpus hiện tại (đang trống), xoá đi thay vì phục vụ dữ liệu cũ
+            stale = target_dir.exists() and any(target_dir.iterdir())
+            if stale:
+                shutil.rmtree(target_dir, ignore_errors=True)
+            _switch_model(target_model, new_emb, ShardedIndex(str(target_dir), new_emb))
+        msg = f"Index trống, đã chuyển ngay sang {target_model}."
+        if stale:
+            msg += f" Đã xoá index cũ không còn khớp ở {target_dir}."
+        return {"ok": True, "message": msg}
+
+    kwargs: Dict[str, Any] = {}
+    if batch_size:
+        kwargs["batch_size"] = batch_size
+    if max_rpm:
+        kwargs["max_rpm"] = max_rpm
+    migration = EmbeddingMigration(
+        vector_store, target_model, _model_index_dir(target_model),
+        write_lock=_write_lock, on_complete=_switch_model, **kwargs,
+    )
+    migration.start()
+    return {"ok": True, "status": migration.status()}
+
+@app.on_event("startup")
+def _resume_migration():
+    # GEMINI_EMB_MODEL đã đổi: vẫn phục vụ bằng model cũ và re-embed nền (resume nếu đã chạy dở)
+    if MIGRATE_ON_START and ENV_EMB_MODEL != EMB_MODEL:
+        print(f"[INFO] Migration embeddings {EMB_MODEL} → {ENV_EMB_MODEL}: {_start_migration(ENV_EMB_MODEL)}")
+
+@app.post("/migrate_embeddings")
+def migrate_embeddings(inp: MigrateIn):
+    """Re-embed chunk đã lưu sang model mới ở nền; /search và /chat vẫn dùng index hiện tại tới khi xong."""
+    return _start_migration(inp.target_model or ENV_EMB_MODEL, inp.batch_size, inp.max_rpm)
+
+@app.get("/migrate_status")
+def migrate_status():
+    if migration is None:
+        return {"ok": True, "active_model": EMB_MODEL, "status": None}
+    return {"ok": True, "active_model": EMB_MODEL, "status": migration.status()}
+
+@app.post("/migrate_stop")
+def migrate_stop():
+    if migration is None or not migration.is_running():
+        return {"ok": False, "error": "Không có migration nào đang chạy."}
+    migration.stop()
+    return {"ok": True, "message": "Đã yêu cầu dừng; chạy lại /migrate_embeddings để tiếp tục."}
+
 # ---------- Feedback ----------
 @app.post("/feedback")
 def feedback(inp: FeedbackIn):
@@ -462,6 +726,42 @@ def _mrr(ranks: List[int]) -> float:
     # ranks: 1-based; None → 0
     return sum(1.0 / r for r in ranks if r and r > 0) / max(1, len(ranks))
 
+def _eval_dense_modes(vs: ShardedIndex, rows: List[Dict[str, Any]], k: int) -> Dict[str, Any]:
+    """
+    So sánh dense two-stage với search phẳng đầy đủ: bộ nhớ (ước tính), latency và Recall@k
+    (gold + overlap). Baseline "full" là IndexFlatL2 nạp tạm từ index.faiss, tức đúng đường
+    search của server khi tắt two-stage.
+    """
+    stats = {m: {"latency_ms": 0.0, "hits": 0} for m in ("full", "two_stage")}
+    overlap = 0.0
+    with vs.full_precision_baseline():
+        for ex in rows:
+            vec = emb.embed_query(ex.get("query", ""))
+            gold_ids = set(ex.get("gold_chunk_ids", []))
+            ids_by_mode = {}
+            for mode in ("full", "two_stage"):
+                t0 = time.perf_counter()
+                docs = vs.dense_search(vec, k=k, mode=mode)
+                stats[mode]["latency_ms"] += (time.perf_counter() - t0) * 1000
+                ids_by_mode[mode] = [d.metadata.get("chunk_id") for d in docs]
+                if gold_ids & set(ids_by_mode[mode]):
+                    stats[mode]["hits"] += 1
+            full_ids = set(ids_by_mode["full"])
+            overlap += len(full_ids & set(ids_by_mode["two_stage"])) / max(1, len(full_ids))
+
+    n = len(rows)
+    return {
+        "memory_bytes_estimate": vs.memory_stats(),
+        "baseline": "faiss.IndexFlatL2 (index.faiss)",
+        **{
+            mode: {
+                "avg_latency_ms": round(st["latency_ms"] / n, 3),
+                "Recall@k/HitRate": round(st["hits"] / n, 4),
+            } for mode, st in stats.items()
+        },
+        "two_stage_overlap@k": round(overlap / n, 4),
+    }
+
 @app.post("/eval_offline")
 def eval_offline(inp: EvalIn):
     err = _ensure_vs_ready()
@@ -495,8 +795,7 @@ def eval_offline(inp: EvalIn):
             gold_ids = set(ex.get("gold_chunk_ids", []))
             keywords = ex.get("keywords", [])
 
-            retr = make_hybrid_retriever(vector_store, k=k)  # type: ignore[arg-type]
-            docs = retr.get_relevant_documents(query)
+            docs = hybrid_search(vector_store, query, k=k)  # type: ignore[arg-type]
             retrieved_ids = [d.metadata.get("chunk_id") for d in docs[:k]]
 
             # hit/rank
@@ -530,4 +829,6 @@ def eval_offline(inp: EvalIn):
         "AnswerKeywordHitRate": round(ans_hit_rate, 4),
         "output_csv": str(EVAL_OUTPUT_CSV),
     }
+    if vector_store.two_stage:  # type: ignore[union-attr]
+        summary["dense"] = _eval_dense_modes(vector_store, rows, k)  # type: ignore[arg-type]
     return {"ok": True, "summary": summary}
@@ -0,0 +1,78 @@
+import os
+import json
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "1").lower() in {"1", "true", "yes"}
+
+__all__ = [
+    "SingleFlight",
+    "coalesce_key",
+    "COALESCE_ENABLED",
+]
+
+def coalesce_key(kind: str, query: str, k: int, filters: Dict[str, Any], version: str) -> str:
+    """Khoá gộp request: query chuẩn hoá (lowercase, gộp khoảng trắng) + k + filter + phiên bản index."""
+    norm = " ".join((query or "").lower().split())
+    return json.dumps([kind, norm, k, filters, version], ensure_ascii=False, sort_keys=True, default=str)
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+class SingleFlight:
+    """
+    Gộp các lời gọi trùng khoá đang chạy đồng thời: request đầu tiên (leader) tính toán,
+    các request trùng đến trong lúc đó chờ và dùng chung kết quả (kể cả exception).
+    Kết quả không được cache sau khi leader xong — request đến sau sẽ tính lại.
+    """
+
+    def __init__(self, enabled: bool = COALESCE_ENABLED):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._stats = {"leaders": 0, "coalesced": 0, "errors": 0}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Trả về (kết quả, shared) — shared=True nếu request này dùng lại kết quả của leader."""
+        if not self.enabled:
+            return fn(), False
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._stats["leaders"] += 1
+            else:
+                self._stats["coalesced"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self._stats["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            st: Dict[str, Any] = dict(self._stats, in_flight=len(self._calls), enabled=self.enabled)
+        total = st["leaders"] + st["coalesced"]
+        st["coalesced_ratio"] = round(st["coalesced"] / total, 4) if total else 0.0
+        return st